@@ -0,0 +1,242 @@
+"""
+Aggregation of maps to IMAGE regions or countries
+
+For every timestep and region the sum, mean, area-weighted mean (garea.nc),
+minimum, maximum and number of cells with data are computed, in one vectorized
+pass over all timesteps (bincount for sums, reduceat over region-sorted cells
+for minima and maxima).
+
+The region of each m-map cell and its area are derived from the region maps
+(region27.nc or countries_grid.nc) and garea.nc, and cached.
+"""
+import os
+import hashlib
+import numpy as np
+import numpy.ma as ma
+from dirs import InputDir, OutputDir, CacheDir, atomic_open
+from instrument import instrument
+from timeaxis import TIME_UNITS, calendar_years, read_years, year_dates
+
+# Region maps in the data directory: file name, variable name
+REGION_MAPS = {
+    'region27': ('region27.nc', 'region27'),
+    'countries': ('countries_grid.nc', 'layer'),
+}
+
+STATISTICS = ['sum', 'mean', 'area_mean', 'min', 'max', 'count']
+
+class RegionIndex:
+    """
+    Region and area of each m-map cell
+
+    Attributes:
+        regions: sorted region IDs
+        codes: position in regions of each m-map cell, len(regions) for cells without region
+        area: area of each m-map cell (km^2)
+        order, starts: m-map cells sorted by region, and the start of each region in order
+    """
+    def __init__(self, regions, codes, area):
+        self.regions = np.asarray(regions)
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.area = np.asarray(area, dtype=np.float64)
+        self.order = np.argsort(self.codes, kind='stable')
+        self.starts = np.searchsorted(self.codes[self.order], np.arange(len(self.regions)))
+
+def load_region_index(region_map, mapping, cache_dir=None):
+    """
+    Returns the RegionIndex of a region map (a key of REGION_MAPS) for the cells of mapping
+
+    The index is cached as an .npz file keyed on the hash of the region map, garea.nc and the mapping.
+    """
+    from functions import nc2m
+
+    region_file, region_var = REGION_MAPS[region_map]
+    sha = hashlib.sha1(mapping.flat.tobytes())
+    for file_loc in (InputDir.data_dir + region_file, InputDir.data_dir + 'garea.nc'):
+        with open(file_loc, 'rb') as f:
+            sha.update(f.read())
+    cache_dir = cache_dir or CacheDir.region_dir
+    cache_file = os.path.join(cache_dir, 'region_' + region_map + '_' + sha.hexdigest() + '.npz')
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            return RegionIndex(cached['regions'], cached['codes'], cached['area'])
+
+    region_ids = mapping.gather(ma.filled(nc2m.read_map(InputDir.data_dir + region_file, region_var, 'float64'), np.nan))
+    area = mapping.gather(ma.filled(nc2m.read_map(InputDir.data_dir + 'garea.nc', 'garea', 'float64'), 0.))
+
+    # Cells without region: NaN, or fill values left unmasked by the region map
+    valid = np.isfinite(region_ids) & (np.abs(region_ids) < 1e30)
+    regions, codes = np.unique(region_ids[valid], return_inverse=True)
+    cell_codes = np.full(len(mapping), len(regions), dtype=np.int64)
+    cell_codes[valid] = codes
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with atomic_open(cache_file, 'wb') as f:
+        np.savez(f, regions=regions, codes=cell_codes, area=area)
+
+    return RegionIndex(regions, cell_codes, area)
+
+def aggregate(values, index):
+    """
+    Returns a dictionary of statistic -> (time, regions) array
+    values: (NC,) or (time, NC) m-map, NaN for cells without data
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    ntimes = len(values)
+    nregions = len(index.regions)
+    nbins = nregions + 1                    # Last bin holds cells without region
+
+    valid = ~np.isnan(values)
+    bins = (np.arange(ntimes)[:, np.newaxis] * nbins + index.codes).ravel()
+
+    def binsum(weights):
+        return np.bincount(bins, weights=weights.ravel(), minlength=ntimes*nbins).reshape(ntimes, nbins)[:, :nregions]
+
+    data = np.where(valid, values, 0.)
+    area = np.where(valid, index.area, 0.)
+    count = binsum(valid.astype(np.float64))
+    total = binsum(data)
+    area_total = binsum(area)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats = {
+            'sum': total,
+            'mean': total / count,
+            'area_mean': binsum(data * index.area) / area_total,
+            'count': count.astype(np.int32),
+        }
+
+    # Min and max over the cells of each region: cells are sorted by region once, then reduced per region
+    in_region = index.order[:np.count_nonzero(index.codes < nregions)]
+    sorted_values = values[:, in_region]
+    sorted_valid = valid[:, in_region]
+    if nregions:
+        stats['min'] = np.minimum.reduceat(np.where(sorted_valid, sorted_values, np.inf), index.starts, axis=1)
+        stats['max'] = np.maximum.reduceat(np.where(sorted_valid, sorted_values, -np.inf), index.starts, axis=1)
+    else:
+        stats['min'] = np.zeros((ntimes, 0))
+        stats['max'] = np.zeros((ntimes, 0))
+    stats['min'][count == 0] = np.nan
+    stats['max'][count == 0] = np.nan
+
+    return stats
+
+class map2region:
+    """
+    Class which aggregates an m-map or netCDF map to regions or countries.
+
+    This class reads in a map (m-map, or a variable in a netCDF map).
+    It also reads in a 'mapping' array which links each m-map row to a x,y coordinate
+
+    Subsequently, all timesteps are aggregated per region at once.
+
+    Then it outputs the statistics as .csv and/or netCDF.
+    """
+    def __init__(self, map_in, map_var, map_outname, timexist, mapping, region_map='region27', output=('csv',)):
+        self.map_in = map_in
+        self.map_var = map_var              # Variable name if map_in is a netCDF map
+        self.map_outname = map_outname
+        self.timexist = timexist
+        self.mapping = mapping
+        self.region_map = region_map        # Key of REGION_MAPS
+        self.output = output                # 'csv' and/or 'nc'
+
+    def run_map2region(self):
+        """
+        First: Read in the map as m-map (NaN where there is no data)
+
+        Second: Aggregate all timesteps per region
+
+        Third: Output the statistics, dated by year (numbered if the map has no years)
+        """
+        # m-maps are read as a whole, of nc-maps only the variable (see read_values)
+        m_in = [] if self.map_in.lower().endswith('.nc') else [InputDir.m_in_dir + self.map_in]
+        with instrument.stage('read', "Reading in map", read=m_in):
+            values, years = self.read_values()
+
+        with instrument.stage('mapping', "Aggregating to {}".format(self.region_map)):
+            index = load_region_index(self.region_map, self.mapping)
+            stats = aggregate(values, index)
+
+        if 'csv' in self.output:
+            csv_out = OutputDir.csv_out_dir + self.map_outname + '_' + self.region_map + '.csv'
+            with instrument.stage('write', "Writing .csv output", written=[csv_out]):
+                self.write_csv(stats, index.regions, csv_out, years)
+        if 'nc' in self.output:
+            nc_out = OutputDir.nc_out_dir + self.map_outname + '_' + self.region_map + '.nc'
+            with instrument.stage('write', "Writing netCDF output", written=[nc_out]):
+                self.write_nc(stats, index.regions, nc_out, years)
+
+    def read_values(self):
+        """
+        Returns the (time, NC) or (NC,) values of the map, with NaN for masked cells, and the year of
+        each timestep (None if the map has no time dimension, or its timesteps are numbered instead)
+        """
+        from functions import nc2m, single_timestep
+        from mcache import mym_cache
+
+        if not self.map_in.lower().endswith('.nc'):
+            mmap = mym_cache.read_mym(self.map_in, path= InputDir.m_in_dir)
+            if self.timexist:
+                return np.asarray(mmap[0], dtype=np.float64), calendar_years(mmap[1])
+            return np.asarray(single_timestep(mmap, self.mapping), dtype=np.float64), None
+
+        import netCDF4
+        from outputs import nc_lock
+        file_loc = InputDir.nc_in_dir + self.map_in
+        with nc_lock, netCDF4.Dataset(file_loc) as nc_map:
+            var_in = nc_map.variables[self.map_var]
+            # The whole variable is read, but not the other variables of the file
+            instrument.count_read(var_in.size * var_in.dtype.itemsize)
+            ntimes = len(var_in)
+            years = read_years(nc_map) if self.timexist else None
+        if not self.timexist:
+            return self.mapping.gather(ma.filled(nc2m.read_map(file_loc, self.map_var, 'float64'), np.nan)), None
+
+        values = np.zeros((ntimes, len(self.mapping)))
+        for t in range(ntimes):
+            values[t] = self.mapping.gather(ma.filled(nc2m.read_map(file_loc, self.map_var, 'float64', index=t), np.nan))
+        return values, calendar_years(years) if years is not None else None
+
+    def write_csv(self, stats, regions, file_loc, years=None):
+        """
+        Writes one row per timestep and region, with the year of the timestep (its number if years is None)
+        """
+        ntimes, nregions = stats['sum'].shape
+        time = np.asarray(years) if years is not None else np.arange(ntimes)
+        table = np.column_stack([np.repeat(time, nregions), np.tile(regions, ntimes)] +
+                                [stats[name].ravel() for name in STATISTICS])
+        np.savetxt(file_loc, table, delimiter=',', header=','.join(['time', 'region'] + STATISTICS), comments='', fmt='%.10g')
+
+    def write_nc(self, stats, regions, file_loc, years=None):
+        """
+        Writes one (time, region) variable per statistic
+        The time coordinate holds the date of each year (as WriteMaps), or timestep numbers if years is None
+        """
+        import netCDF4
+        from outputs import WriteMaps, nc_lock
+
+        with nc_lock, netCDF4.Dataset(file_loc, mode='w', format='NETCDF4_CLASSIC') as ncfile:
+            ncfile.createDimension('time', len(stats['sum']))
+            ncfile.createDimension('region', len(regions))
+            writemap = WriteMaps(None, self.map_outname + ' per ' + self.region_map, self.map_var, '-', self.map_outname, self.timexist)
+            ncfile.title, ncfile.unit, ncfile.author, ncfile.contact, ncfile.date, ncfile.model, ncfile.repository, ncfile.revision, ncfile.institution, ncfile.institution2, ncfile.references, ncfile.disclaimer = writemap.get_ncattributes()
+
+            region = ncfile.createVariable('region', np.int32, ('region',))
+            region.long_name = self.region_map
+            region[:] = regions
+            if years is not None:
+                time = ncfile.createVariable('time', np.float64, ('time',))
+                time.units = TIME_UNITS
+                time.calendar = 'standard'
+                time.standard_name = 'time'
+                time[:] = year_dates(years)
+            else:
+                time = ncfile.createVariable('time', np.int32, ('time',))
+                time.long_name = 'timestep'
+                time[:] = np.arange(len(stats['sum']))
+
+            for name in STATISTICS:
+                var = ncfile.createVariable(name, np.int32 if name == 'count' else np.float64, ('time', 'region'), zlib=True)
+                var[:] = stats[name]
@@ -0,0 +1,140 @@
+"""
+In-memory conversions between m-maps, grids and netCDF datasets
+
+The file-based converters (functions.py, batch.py) read from and write to the
+directories in dirs.py. This module converts arrays and open datasets directly,
+without files on disk, with the same readers and writers (nc2m.read_dataset, WriteMaps):
+
+    to_grid(values)                 m-map (..., cells (, classes)) -> grid (..., lat, lon (, classes))
+    to_vector(gridmap)              grid (..., lat, lon) -> m-map (..., cells)
+    to_dataset(values, name)        m-map -> in-memory netCDF4 dataset, as written by m2nc
+    from_dataset(dataset, var_name) netCDF4 or xarray dataset -> m-map, as read by nc2m
+
+All functions use the cell mapping of data/mcoord.txt by default, loaded once per
+process (get_mapping). Reordering axes gives views, only the scatter and gather copy.
+
+    import api
+    gridmap = api.to_grid(mmap)                             # (time, 360, 720)
+    mmap = api.to_vector(gridmap)                           # (time, 66663)
+    ds = api.to_dataset(mmap, 'BFCellFrac', timexist=True)  # netCDF4.Dataset in memory
+"""
+import numpy as np
+import numpy.ma as ma
+from dirs import InputDir
+from grid import Grid, regrid
+from mapping import load_mmapping
+
+# Cell mappings of this process, by coordinate file
+_mappings = {}
+
+def get_mapping(coord_file=None):
+    """
+    Returns the CellMapping of a coordinate file (InputDir.data_dir + 'mcoord.txt' by default),
+    loaded once per process
+    """
+    coord_file = coord_file or InputDir.data_dir + 'mcoord.txt'
+    if coord_file not in _mappings:
+        _mappings[coord_file] = load_mmapping(coord_file)
+    return _mappings[coord_file]
+
+def get_cell_axis(values, mapping):
+    """
+    Axis of the m-map cells: the last axis with one element per mapping cell
+    """
+    shape = np.shape(values)
+    if len(mapping) not in shape:
+        raise ValueError("No axis of {} cells in values of shape {}".format(len(mapping), shape))
+    return len(shape) - 1 - shape[::-1].index(len(mapping))
+
+def to_grid(values, mapping=None, out_res=None, how='mean', refine_how='copy'):
+    """
+    Returns the grid of an m-map, NaN outside the mapping cells
+        values: (..., cells) m-map, or (..., cells, classes) multi-column m-map
+        out_res: resolution of the grid in degrees, the mapping grid by default (regridded with how or refine_how, see grid.regrid)
+
+    Output: (..., lat, lon) grid, or (..., lat, lon, classes)
+    """
+    mapping = mapping or get_mapping()
+    cell_axis = get_cell_axis(values, mapping)
+    values = np.moveaxis(np.asarray(values), cell_axis, -1)
+    out_grid = Grid.from_resolution(out_res) if out_res else mapping.grid
+    gridmap = regrid(mapping.scatter(values), mapping.grid, out_grid, how, refine_how)
+    return np.moveaxis(gridmap, (-2, -1), (cell_axis, cell_axis + 1))
+
+def to_vector(gridmap, mapping=None, how='mean', refine_how='copy'):
+    """
+    Returns the m-map of a (..., lat, lon) grid. Masked cells keep their underlying data
+    Grids at another resolution than the mapping are regridded first (with how or refine_how, see grid.regrid)
+
+    Output: (..., cells) m-map
+    """
+    mapping = mapping or get_mapping()
+    gridmap = ma.getdata(gridmap)
+    if gridmap.shape[-2:] != mapping.shape:
+        gridmap = regrid(gridmap.astype(np.float64), Grid(*gridmap.shape[-2:]), mapping.grid, how, refine_how)
+    return mapping.gather(gridmap)
+
+def to_dataset(values, name, timexist=False, mapping=None, title=None, unit='-', classes=None, layout='grid', years=None, **nc_options):
+    """
+    Returns an m-map as in-memory netCDF4 dataset (read-only), the same as m2nc would write it
+        values: (time, cells (, classes)) m-map if timexist, otherwise (cells (, classes))
+        name: variable name
+        classes: class names of a multi-column m-map (see WriteMaps.create_nc)
+        layout: 'grid' or 'landpoint' (see m2nc)
+        years: year of each timestep, written as dates (timestep numbers by default)
+        nc_options: storage options of WriteMaps.create_nc
+    """
+    import netCDF4
+    from outputs import WriteMaps
+
+    mapping = mapping or get_mapping()
+    values = np.asarray(values)
+    nclasses = values.ndim - 1 - get_cell_axis(values, mapping)
+    dim1 = 'EMPTY' if not nclasses else (classes if classes is not None else values.shape[-1])
+
+    outmap = values if layout == 'landpoint' else to_grid(values, mapping)
+    writemap = WriteMaps(outmap, title or name, name, unit, name, timexist, years)
+    memory = writemap.maptime2nc(dim1, landpoints=mapping if layout == 'landpoint' else None, in_memory=True, **nc_options)
+    return netCDF4.Dataset(name + '.nc', memory=bytes(memory))
+
+def from_dataset(dataset, var_name, mapping=None, timexist=None, time_index=None, dim3_index=None, multiplier=1, years=None):
+    """
+    Returns the m-map of a variable of an open netCDF4 or xarray dataset, the same as nc2m would read it
+    (with NaN set to 0 if there is a time dimension)
+        timexist: whether the variable has a time dimension, by default if it has a 'time' dimension
+        time_index: timesteps to read, all by default
+        years: years to read (instead of time_index), see timeaxis.py
+        dim3_index: index of the 3rd dimension (class) to read, None or False for no selection
+
+    Variables of xarray datasets are read by the same slice reader (nc2m.read_slice), with two differences:
+    xarray has already decoded fill values to NaN (and masked cells keep no other data), and land point
+    (compressed) variables are not supported.
+    """
+    from functions import nc2m
+
+    mapping = mapping or get_mapping()
+    if type(dataset).__module__.startswith('xarray'):
+        # xarray: the (lazily loaded) variable is selected before it is converted to numpy
+        var_in = dataset[var_name]
+        if timexist is None:
+            timexist = 'time' in var_in.dims
+        if timexist and years is not None:
+            from timeaxis import year_index
+            var_in = var_in.isel(time=year_index(var_in['time'].dt.year.values, years))
+        elif timexist and time_index is not None:
+            var_in = var_in.isel(time=list(time_index))
+        converter = nc2m(None, var_name, None, timexist, None, dim3_index, None, multiplier, mapping)
+        values = var_in.to_numpy()
+        read_type = None if values.dtype == np.float64 else 'float32'
+        if not timexist:
+            return converter.get_vectormap(converter.read_slice(values, (), read_type), mapping, False)
+        vectormap = np.zeros((len(values), len(mapping)))
+        for t in range(len(values)):
+            vectormap[t] = converter.get_vectormap(converter.read_slice(values, (t,), read_type), mapping, False)
+        vectormap[np.isnan(vectormap)] = 0
+        return vectormap
+
+    if timexist is None:
+        timexist = 'time' in dataset.variables[var_name].dimensions
+    converter = nc2m(None, var_name, None, timexist, None, dim3_index, None, multiplier, mapping, years=years)
+    return converter.read_dataset(dataset, time_index)
@@ -0,0 +1,204 @@
+"""
+Batch runner which converts all maps listed in a job manifest
+
+The manifest is a JSON or TOML file with a list of jobs. Each job has a 'type'
+(m2nc, mmaps, nc2m, list or aggregate) and the same fields as the corresponding class
+in functions.py (mmaps: mmaps2nc, aggregate: map2region in aggregate.py).
+An optional 'name' identifies the job in the summary. m2nc and list jobs accept
+'nc_options' with the storage options of WriteMaps.maptime2nc, i.e.
+{"dtype": "f4", "complevel": 6, "chunking": "timeseries", "least_significant_digit": 3}.
+nc2m jobs select a class of a 3rd dimension with 'dim3_index' (0, 1, ...; null or false to read all classes).
+nc2m jobs accept 'mfile_writer' ("pym" or "native"), 'side_output' ("npy", "parquet" or null) and 'csv'.
+m2nc jobs accept 'out_res' (output resolution in degrees, i.e. 1 or 0.0833333), 'regrid_how' (coarsening) and 'refine_how',
+'classes' (names of the columns of multi-column m-maps) and 'layout' ("grid" or "landpoint"),
+nc2m jobs on another grid than the mapping are regridded with 'regrid_how' or 'refine_how' (see grid.py).
+m2nc, mmaps and nc2m jobs with a time dimension accept 'years' (i.e. [2000, 2020, 2050, 2100]):
+only these timesteps are read and converted (see timeaxis.py).
+
+    {"jobs": [
+        {"type": "m2nc", "mmap_in": "BFCellFrac.dat", "map_title": "Fraction of Grid Cell Currently Used for Biofuels",
+         "map_var": "BFCellFrac", "map_unit": "-", "map_outname": "BFCellFrac", "timexist": true},
+        {"type": "mmaps", "mmaps_list": [["nw_EmisType2ST_pkm.out", "NWOOD_EF_Gradual", "kgCO2/km^2"],
+                                         ["wd_EmisType2ST_pkm.out", "WOODY_EF_Gradual", "kgCO2/km^2"]],
+         "map_title": "Gradual Emission Factors", "map_outname": "EF_Gradual", "timexist": false},
+        {"type": "nc2m", "ncmap_in": "GLANDCOVERDETAIL_30MIN_HE.nc", "map_var": "GLANDCOVERDETAIL_30MIN",
+         "map_outname": "Half_Earth_constraint", "timexist": true, "timestep": 2100, "dim3_index": 5,
+         "comment": "Half Earth Biodiversity Constraint", "multiplier": 1},
+        {"type": "list", "list_in": "Mapping_countries_grid_feasibility.xlsx", "sheet_name": "Mapping", "header": 1,
+         "id_col": "grdID", "idmap_in": "countries_grid.nc", "idmap_var": "layer", "tonc": true, "tom": true,
+         "maps_list": [["spfs_cor", "Socio-political feasability score", "-", "socio-political_feasability_score", "Roe et al (2021)"]]},
+        {"type": "aggregate", "map_in": "BFCellFrac.dat", "map_var": "BFCellFrac", "map_outname": "BFCellFrac",
+         "timexist": true, "region_map": "region27", "output": ["csv", "nc"]}
+    ]}
+
+Usage:
+    python batch.py manifest.json --workers 4 --summary batch_summary.json --root ~/scenarios/SSP2
+
+Jobs run on a process pool. The cell mapping is loaded once and handed to every worker.
+With --in-flight N, jobs instead run in one process in a thread pipeline (pipeline.py) which
+reads the next job while converting and writing the previous ones, with at most N jobs in memory.
+A failing job is recorded in the summary and does not stop the other jobs. The summary
+holds the wall time, stage timings, bytes read/written and peak RSS of every job.
+
+Jobs whose outputs are up to date (same inputs, job fields and tool version, see buildstate.py)
+are skipped, unless --force is given.
+"""
+import os
+import sys
+import json
+import argparse
+import functools
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import dirs
+from api import get_mapping
+from mcache import mym_cache
+from instrument import instrument
+from buildstate import BuildState
+from pipeline import run_pipeline, WholeJob
+import worker
+
+def read_manifest(manifest_file):
+    """
+    Returns the list of jobs in a JSON or TOML manifest
+    """
+    jobs = worker.read_entries(manifest_file, 'jobs')
+    for i, job in enumerate(jobs):
+        if job.get('type') not in ('m2nc', 'mmaps', 'nc2m', 'list', 'aggregate'):
+            raise ValueError("Job {} in {} has unknown type: {}".format(i, manifest_file, job.get('type')))
+    return jobs
+
+def job_name(job):
+    """
+    Name of a job in the summary: its 'name' field or its output name
+    """
+    return job.get('name') or job.get('map_outname') or job.get('list_in')
+
+def make_converter(job):
+    """
+    Returns the converter of a job, with read, convert and write methods (see pipeline.py)
+    """
+    from functions import m2nc, mmaps2nc, nc2m, list2map
+    from aggregate import map2region
+
+    fields = {key: value for key, value in job.items() if key not in ('type', 'name')}
+    if job['type'] == 'm2nc':
+        return m2nc(mapping=worker.mapping, **fields)
+    if job['type'] == 'nc2m':
+        return nc2m(mapping=worker.mapping, **fields)
+    if job['type'] == 'mmaps':
+        return WholeJob(mmaps2nc(mapping=worker.mapping, **fields).run_mmaps2nc)
+    if job['type'] == 'aggregate':
+        return WholeJob(map2region(mapping=worker.mapping, **fields).run_map2region)
+    maps_list = fields.pop('maps_list')
+    tonc = fields.pop('tonc', True)
+    tom = fields.pop('tom', False)
+    converter = list2map(mapping=worker.mapping, **fields)
+    return WholeJob(lambda: converter.run_list2map(maps_list, tonc, tom))
+
+def run_job(job):
+    """
+    Runs a single job and returns its summary: name, type, status, error (if any),
+    and the instrumentation record (seconds, stages, bytes read/written, peak RSS)
+    """
+    try:
+        with instrument.job(job_name(job), job['type']) as record:
+            converter = make_converter(job)
+            converter.read()
+            converter.convert()
+            converter.write()
+        status, error = 'ok', None
+    except Exception:
+        status, error = 'failed', traceback.format_exc()
+        instrument.log("\tFailed: {}".format(job_name(job)), 1)
+
+    return dict(record, status=status, error=error)
+
+def skipped_job(job):
+    """
+    Summary of a job which is skipped because its outputs are up to date
+    """
+    return {'name': job_name(job), 'type': job['type'], 'stages': [], 'bytes_read': 0, 'bytes_written': 0,
+            'seconds': 0., 'peak_rss_mb': None, 'status': 'skipped', 'error': None}
+
+def run_batch(jobs, mapping, workers=1, cache_enabled=True, cache_max_bytes=mym_cache.max_bytes, verbosity=instrument.verbosity, state=None, force=False, in_flight=0):
+    """
+    Runs all jobs, on a process pool if workers > 1, and returns their summaries in manifest order
+    If in_flight > 0, jobs run in this process in a thread pipeline (see pipeline.py) with at most in_flight jobs in memory
+    If a BuildState is given, the outputs of successful jobs are recorded, and up to date jobs are skipped unless force
+    """
+    todo = [job for job in jobs if state is None or force or not state.is_up_to_date(job)]
+    instrument.log("{} of {} jobs up to date".format(len(jobs) - len(todo), len(jobs)), 1)
+
+    if not todo:
+        results = []
+    elif in_flight > 0:
+        worker.init_worker(mapping, verbosity, cache_enabled=cache_enabled, cache_max_bytes=cache_max_bytes)
+        results = run_pipeline(((job_name(job), job['type'], functools.partial(make_converter, job)) for job in todo), in_flight)
+    elif workers <= 1:
+        worker.init_worker(mapping, verbosity, cache_enabled=cache_enabled, cache_max_bytes=cache_max_bytes)
+        results = [run_job(job) for job in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo)), initializer=worker.init_worker, initargs=(mapping, verbosity, dirs.settings(), cache_enabled, cache_max_bytes)) as pool:
+            results = list(pool.map(run_job, todo))
+
+    if state is not None:
+        for job, result in zip(todo, results):
+            if result['status'] == 'ok':
+                state.record(job)
+        state.save()
+
+    ran = {id(job): result for job, result in zip(todo, results)}
+    return [ran[id(job)] if id(job) in ran else skipped_job(job) for job in jobs]
+
+def write_summary(results, summary_file):
+    """
+    Writes the per-job summary (status and instrumentation) as JSON and prints a short overview
+    """
+    peak_rss = [result['peak_rss_mb'] for result in results if result['peak_rss_mb'] is not None]
+    with open(summary_file, 'w') as f:
+        json.dump({'jobs': results,
+                   'failed': sum(result['status'] == 'failed' for result in results),
+                   'skipped': sum(result['status'] == 'skipped' for result in results),
+                   'seconds': round(sum(result['seconds'] for result in results), 3),
+                   'bytes_read': sum(result['bytes_read'] for result in results),
+                   'bytes_written': sum(result['bytes_written'] for result in results),
+                   'peak_rss_mb': max(peak_rss) if peak_rss else None}, f, indent=2)
+
+    for result in results:
+        instrument.log("{:<8} {:>9.2f}s  {:<5} {}".format(result['status'], result['seconds'], result['type'], result['name']), 1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert all maps listed in a job manifest (JSON or TOML)")
+    parser.add_argument('manifest', help="Job manifest file")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--summary', default='batch_summary.json', help="File to write the per-job summary to")
+    parser.add_argument('--no-cache', action='store_true', help="Always parse m-maps, bypassing the m-map cache")
+    parser.add_argument('--clear-cache', action='store_true', help="Remove all cached m-maps before running")
+    parser.add_argument('--cache-max-gb', type=float, default=mym_cache.max_bytes / 1024**3, help="Size limit of the m-map cache in GB")
+    parser.add_argument('--verbosity', type=int, default=1, choices=range(4), help="0: quiet, 1: jobs, 2: stages, 3: stage timings")
+    parser.add_argument('--in-flight', type=int, default=0, help="Run jobs in a read/convert/write thread pipeline in one process, with at most this many jobs in memory (instead of worker processes)")
+    parser.add_argument('--force', action='store_true', help="Run all jobs, also those whose outputs are up to date")
+    parser.add_argument('--no-state', action='store_true', help="Neither check nor record the build state")
+    parser.add_argument('--root', help="Directory holding the data, input, output and cache directories (default: working directory)")
+    parser.add_argument('-q', '--quiet', dest='verbosity', action='store_const', const=0, help="Same as --verbosity 0")
+    args = parser.parse_args(argv)
+    instrument.verbosity = args.verbosity
+    if args.root:
+        dirs.configure(args.root)
+    dirs.make_output_dirs()
+
+    if args.clear_cache:
+        mym_cache.clear()
+
+    jobs = read_manifest(args.manifest)
+    mapping = get_mapping()
+
+    state = None if args.no_state else BuildState(dirs.OutputDir.state_file)
+    results = run_batch(jobs, mapping, args.workers, not args.no_cache, int(args.cache_max_gb * 1024**3), args.verbosity, state, args.force, args.in_flight)
+    write_summary(results, args.summary)
+
+    return 1 if any(result['status'] == 'failed' for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
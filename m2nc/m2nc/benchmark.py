@@ -0,0 +1,280 @@
+"""
+Benchmarks of all conversion paths (m2nc, nc2m, list2nc) on synthetic IMAGE maps
+
+Synthetic m-maps and netCDF maps are built from the bundled data/mcoord.txt and
+data/countries_grid.nc, for several time lengths and with and without a 3rd dimension.
+Each stage and each end-to-end conversion is timed (best of --repeat runs) and its
+peak traced memory (tracemalloc, in a separate run) is recorded. Results are written
+as JSON, and can be compared against a stored baseline: a stage regresses if its time
+or peak memory grows by more than --threshold (relative).
+
+The cold start of the command line tools (interpreter start, imports and argument parsing)
+is timed in fresh interpreters against STARTUP_BUDGET, and the heavy dependencies they
+import at startup are recorded (these should only load when a conversion needs them).
+
+Usage:
+    python benchmark.py --output bench_results.json
+    python benchmark.py --output bench_results.json --baseline bench_baseline.json --threshold 0.25
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import platform
+import tempfile
+import datetime as dt
+import tracemalloc
+import contextlib
+import numpy as np
+import netCDF4
+import dirs
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data') + os.sep
+
+# (timesteps, length of 3rd dimension or None)
+CASES = [(1, None), (27, None), (132, None), (27, 6)]
+QUICK_CASES = [(1, None), (27, None), (27, 6)]
+
+# Cold-start budget of the command line tools (seconds)
+STARTUP_BUDGET = 1.0
+STARTUP_COMMANDS = {
+    'batch --help': ['batch.py', '--help'],
+    'compare --help': ['compare.py', '--help'],
+    'import m2nc': ['-c', 'import m2nc'],
+}
+HEAVY_MODULES = ['netCDF4', 'pym', 'pandas', 'openpyxl', 'pyarrow']
+
+class Benchmark:
+    """
+    Runs benchmark stages in a scratch directory and collects their results
+    """
+    def __init__(self, work_dir, repeat=3):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.results = {}
+
+        # Point all input and output directories to the scratch directory
+        for cls in (dirs.InputDir, dirs.OutputDir, dirs.CacheDir):
+            for name, value in list(vars(cls).items()):
+                if name.endswith('_dir'):
+                    path = os.path.join(work_dir, name) + os.sep
+                    os.makedirs(path, exist_ok=True)
+                    setattr(cls, name, path)
+        dirs.InputDir.data_dir = DATA_DIR
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Runs func once with memory tracing for its peak traced memory, and then
+        repeat times without (tracing slows down Python allocations) for its best time
+        Returns the result of the last run
+        """
+        with contextlib.redirect_stdout(io.StringIO()):
+            tracemalloc.start()
+            func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            seconds = []
+            for _ in range(self.repeat):
+                start = time.perf_counter()
+                result = func(*args, **kwargs)
+                seconds.append(time.perf_counter() - start)
+
+        self.results[name] = {'seconds': round(min(seconds), 5), 'peak_mb': round(peak / 1024**2, 3)}
+        print("{:<40} {:>10.4f}s {:>10.1f}MB".format(name, min(seconds), peak / 1024**2))
+        return result
+
+    def skip(self, name, reason):
+        self.results[name] = {'skipped': reason}
+        print("{:<40} skipped: {}".format(name, reason))
+
+def write_ncmap(file_loc, var_name, gridmap, timexist, ndim3):
+    """
+    Writes a synthetic (time,) lat, lon (, dim3) netCDF input map
+    """
+    with netCDF4.Dataset(file_loc, 'w') as ncfile:
+        dims = ()
+        if timexist:
+            ncfile.createDimension('time', gridmap.shape[0])
+            dims += ('time',)
+        ncfile.createDimension('lat', 360)
+        ncfile.createDimension('lon', 720)
+        dims += ('lat', 'lon')
+        if ndim3:
+            ncfile.createDimension('class', ndim3)
+            dims += ('class',)
+        var = ncfile.createVariable(var_name, np.float32, dims, fill_value=-9999., zlib=True)
+        if ndim3:
+            var[:] = np.repeat(np.nan_to_num(gridmap, nan=-9999.)[..., np.newaxis], ndim3, axis=-1)
+        else:
+            var[:] = np.nan_to_num(gridmap, nan=-9999.)
+
+def run_startup(bench):
+    """
+    Times the cold start of each command (best of repeat runs, each in a fresh interpreter),
+    and records the heavy modules imported by the command line tools at startup
+    """
+    tool_dir = os.path.dirname(os.path.abspath(__file__))
+    for name, args in STARTUP_COMMANDS.items():
+        seconds = []
+        for _ in range(bench.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + args, cwd=tool_dir, stdout=subprocess.DEVNULL, check=True)
+            seconds.append(time.perf_counter() - start)
+        bench.results['startup/' + name] = {'seconds': round(min(seconds), 5), 'budget': STARTUP_BUDGET}
+        print("{:<40} {:>10.4f}s (budget {}s)".format('startup/' + name, min(seconds), STARTUP_BUDGET))
+
+    script = 'import sys, json, batch, compare, m2nc, api; print(json.dumps([m for m in {} if m in sys.modules]))'.format(HEAVY_MODULES)
+    loaded = json.loads(subprocess.run([sys.executable, '-c', script], cwd=tool_dir, capture_output=True, text=True, check=True).stdout)
+    bench.results['startup/heavy_modules'] = {'loaded': loaded}
+    print("{:<40} {}".format('startup/heavy_modules', ', '.join(loaded) or 'none'))
+
+def over_budget(results):
+    """
+    Returns the startup commands which exceed their budget, or import heavy modules
+    """
+    failures = [(name, result['seconds']) for name, result in results.items() if 'budget' in result and result['seconds'] > result['budget']]
+    loaded = results.get('startup/heavy_modules', {}).get('loaded')
+    if loaded:
+        failures.append(('startup/heavy_modules', loaded))
+    return failures
+
+def run_benchmarks(bench, cases):
+    """
+    Runs all stages and end-to-end conversions
+    """
+    from mapping import get_mmapping, load_mmapping
+    from functions import m2nc, nc2m, list2map, join_list
+    from outputs import WriteMaps
+    from mwriter import write_mfile, write_csv
+    from mcache import mym_cache
+
+    rng = np.random.default_rng(0)
+
+    # *** MAPPING ***
+    grdfile = np.loadtxt(DATA_DIR + 'mcoord.txt')
+    mapping = bench.run('mapping/get_mmapping', get_mmapping, grdfile)
+    load_mmapping(DATA_DIR + 'mcoord.txt', dirs.CacheDir.mapping_dir)
+    bench.run('mapping/load_mmapping (cached)', load_mmapping, DATA_DIR + 'mcoord.txt', dirs.CacheDir.mapping_dir)
+
+    try:
+        import pym
+    except ImportError:
+        pym = None
+
+    for ntimes, ndim3 in cases:
+        timexist = ntimes > 1
+        case = 'T{}'.format(ntimes) + ('xC{}'.format(ndim3) if ndim3 else '')
+        mmap = rng.random((ntimes, len(mapping)))
+
+        # *** m2nc ***
+        gridmap = bench.run('m2nc/scatter/' + case, mapping.scatter, mmap if timexist else mmap[0])
+        writemap = WriteMaps(gridmap, 'Benchmark', 'bench', '-', 'bench_' + case, timexist)
+        bench.run('m2nc/maptime2nc/' + case, writemap.maptime2nc)
+        if timexist:
+            writemap = WriteMaps(None, 'Benchmark', 'bench', '-', 'bench_stream_' + case, timexist)
+            converter = m2nc(None, 'Benchmark', 'bench', '-', 'bench_stream_' + case, timexist, mapping)
+            bench.run('m2nc/stream2nc/' + case, lambda: writemap.stream2nc(converter.get_gridslices(mmap, mapping), (ntimes,) + mapping.shape))
+
+        if pym is None:
+            bench.skip('m2nc/end-to-end (parse)/' + case, 'pym not installed')
+        elif not ndim3:
+            mfile = 'bench_' + case + '.out'
+            if timexist:
+                pym.write_mym(data=mmap, years=np.arange(ntimes), variable_name='data', filename=mfile, path=dirs.InputDir.m_in_dir)
+            else:
+                pym.write_mym(data=mmap, variable_name='data', filename=mfile, path=dirs.InputDir.m_in_dir)
+            converter = m2nc(mfile, 'Benchmark', 'bench', '-', 'bench_m2nc_' + case, timexist, mapping)
+            mym_cache.enabled = False
+            bench.run('m2nc/end-to-end (parse)/' + case, converter.run_m2nc)
+            mym_cache.enabled = True
+            bench.run('m2nc/end-to-end (cached)/' + case, converter.run_m2nc)
+
+        # *** nc2m ***
+        ncfile = 'bench_in_' + case + '.nc'
+        write_ncmap(dirs.InputDir.nc_in_dir + ncfile, 'bench', gridmap, timexist, ndim3)
+        bench.run('nc2m/read_map/' + case, nc2m.read_map, dirs.InputDir.nc_in_dir + ncfile, 'bench')
+        bench.run('nc2m/gather/' + case, nc2m.get_vectormap, gridmap, mapping, timexist)
+        converter = nc2m(ncfile, 'bench', 'bench_nc2m_' + case, timexist, ntimes, ndim3 and 2, 'Benchmark', 1, mapping, mfile_writer='native')
+        vectormap = bench.run('nc2m/read_vectormap/' + case, converter.read_vectormap, dirs.InputDir.nc_in_dir + ncfile)
+        years = np.arange(len(vectormap)) if timexist else None
+        bench.run('nc2m/write_mfile/' + case, write_mfile, vectormap, 'bench_' + case + '.out', dirs.OutputDir.m_out_dir, years)
+        bench.run('nc2m/write_csv/' + case, write_csv, vectormap, dirs.OutputDir.csv_out_dir + 'bench_' + case + '.csv')
+        bench.run('nc2m/end-to-end/' + case, converter.run_nc2m)
+
+        # Byte-for-byte parity of the native m-file writer with pym
+        if pym is not None and not ndim3:
+            pym.write_mym(data=vectormap, years=years, variable_name='data', filename='parity_pym_' + case, path=dirs.OutputDir.m_out_dir)
+            write_mfile(vectormap, 'parity_native_' + case, dirs.OutputDir.m_out_dir, years)
+            with open(dirs.OutputDir.m_out_dir + 'parity_pym_' + case, 'rb') as f_pym, open(dirs.OutputDir.m_out_dir + 'parity_native_' + case, 'rb') as f_native:
+                bench.results['nc2m/mfile_parity/' + case] = {'identical': f_pym.read() == f_native.read()}
+
+    # *** list2nc ***
+    idmap = nc2m.read_map(DATA_DIR + 'countries_grid.nc', 'layer')
+    ids = np.unique(idmap.compressed())
+    values = rng.random((len(ids), 10))
+    bench.run('list2nc/join_list (10 columns)', join_list, idmap, ids, values)
+
+    list_file = 'bench_list.csv'
+    header = 'grdID,' + ','.join('col{}'.format(i) for i in range(values.shape[1]))
+    np.savetxt(dirs.InputDir.list_in_dir + list_file, np.column_stack((ids, values)), delimiter=',', header=header, comments='')
+    maps_list = [['col{}'.format(i), 'Benchmark', '-', 'bench_list_col{}'.format(i), 'Benchmark'] for i in range(values.shape[1])]
+    converter = list2map(list_file, None, 0, 'grdID', 'countries_grid.nc', 'layer', mapping)
+    bench.run('list2nc/end-to-end (10 columns)', converter.run_list2map, maps_list, True, False)
+
+def compare(results, baseline, threshold):
+    """
+    Returns the stages whose time or peak memory regressed by more than threshold compared to baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or 'seconds' not in result or 'seconds' not in base:
+            continue
+        for key in ('seconds', 'peak_mb'):
+            if key in result and base.get(key, 0) > 0 and result[key] > base[key] * (1 + threshold):
+                regressions.append((name, key, base[key], result[key]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the m2nc conversion paths on synthetic maps")
+    parser.add_argument('--output', default='bench_results.json', help="File to write the results to")
+    parser.add_argument('--baseline', help="Results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed relative regression of time and peak memory")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs per stage (best time is kept)")
+    parser.add_argument('--quick', action='store_true', help="Skip the 132 timestep case")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='m2nc_bench_')
+    try:
+        bench = Benchmark(work_dir, args.repeat)
+        run_startup(bench)
+        run_benchmarks(bench, QUICK_CASES if args.quick else CASES)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'meta': {'date': str(dt.datetime.now()), 'python': platform.python_version(), 'numpy': np.__version__,
+                       'netCDF4': netCDF4.__version__, 'platform': platform.platform(), 'repeat': args.repeat},
+              'results': bench.results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    failures = over_budget(bench.results)
+    for name, value in failures:
+        print("OVER BUDGET {:<40} {}".format(name, value))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(bench.results, baseline, args.threshold)
+        for name, key, base, new in regressions:
+            print("REGRESSION {:<40} {}: {} -> {}".format(name, key, base, new))
+        return 1 if regressions or failures else 0
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
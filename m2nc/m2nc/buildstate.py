@@ -0,0 +1,150 @@
+"""
+Build state of converted maps, used to skip jobs whose inputs and settings are unchanged
+
+For every output file the state records the job parameters, the tool version
+(metadata.__version__), the size and mtime of the output, and the size, mtime
+and sha1 of every input (including the cell mapping, data/mcoord.txt).
+A job is up to date if all its outputs exist unchanged and were produced by the
+same parameters and version from the same inputs. Inputs are compared by size
+and mtime first, and only hashed if these changed (i.e. a file was touched or
+copied), so checking a large manifest without changes costs a few stat calls per job.
+"""
+import os
+import json
+import metadata
+from dirs import InputDir, OutputDir, atomic_open, file_sha1
+
+def file_stat(file_loc):
+    stat = os.stat(file_loc)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def job_files(job):
+    """
+    Returns the input and output files of a job (see batch.py for the job fields)
+    """
+    inputs = [InputDir.data_dir + 'mcoord.txt']
+    outputs = []
+    if job['type'] == 'm2nc':
+        inputs.append(InputDir.m_in_dir + job['mmap_in'])
+        outputs.append(OutputDir.nc_out_dir + job['map_outname'] + '.nc')
+    elif job['type'] == 'mmaps':
+        inputs += [InputDir.m_in_dir + mmap[0] for mmap in job['mmaps_list']]
+        outputs.append(OutputDir.nc_out_dir + job['map_outname'] + '.nc')
+    elif job['type'] == 'nc2m':
+        inputs.append(InputDir.nc_in_dir + job['ncmap_in'])
+        outputs.append(OutputDir.m_out_dir + job['map_outname'])
+        side_output = job.get('side_output', 'npy')
+        if side_output:
+            bin_out = OutputDir.bin_out_dir + job['map_outname']
+            outputs.append(bin_out + ('.parquet' if side_output == 'parquet' else '.npy'))
+            if side_output == 'npy' and job.get('timexist'):
+                outputs.append(bin_out + '_years.npy')
+        if job.get('csv'):
+            outputs.append(OutputDir.csv_out_dir + job['map_outname'] + '.csv')
+    elif job['type'] == 'list':
+        inputs += [InputDir.list_in_dir + job['list_in'], InputDir.data_dir + job['idmap_in']]
+        for outmap in job['maps_list']:
+            if job.get('tonc', True):
+                outputs.append(OutputDir.nc_out_dir + outmap[3] + '.nc')
+            if job.get('tom', False):
+                outputs.append(OutputDir.m_out_dir + outmap[3])
+    elif job['type'] == 'aggregate':
+        from aggregate import REGION_MAPS
+        map_in = job['map_in']
+        inputs.append((InputDir.nc_in_dir if map_in.lower().endswith('.nc') else InputDir.m_in_dir) + map_in)
+        region_map = job.get('region_map', 'region27')
+        inputs += [InputDir.data_dir + REGION_MAPS[region_map][0], InputDir.data_dir + 'garea.nc']
+        output = job.get('output', ('csv',))
+        if 'csv' in output:
+            outputs.append(OutputDir.csv_out_dir + job['map_outname'] + '_' + region_map + '.csv')
+        if 'nc' in output:
+            outputs.append(OutputDir.nc_out_dir + job['map_outname'] + '_' + region_map + '.nc')
+    return inputs, outputs
+
+def job_params(job):
+    """
+    Parameters of a job which determine its outputs, in canonical form (the job 'name' does not)
+    """
+    return json.loads(json.dumps({key: value for key, value in job.items() if key != 'name'}, sort_keys=True, default=str))
+
+class BuildState:
+    """
+    Build state database: output file -> record of the job, version and inputs which produced it,
+    stored as JSON in state_file (OutputDir.state_file by default)
+    """
+    def __init__(self, state_file=None):
+        self.state_file = state_file or OutputDir.state_file
+        self.outputs = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                self.outputs = json.load(f).get('outputs', {})
+
+    def is_up_to_date(self, job):
+        """
+        True if all outputs of the job exist unchanged and were produced from unchanged inputs,
+        with the same job parameters and tool version
+        """
+        inputs, outputs = job_files(job)
+        if not outputs:
+            return False
+        params = job_params(job)
+        for out_file in outputs:
+            record = self.outputs.get(out_file)
+            if record is None or record['version'] != metadata.__version__ or record['params'] != params:
+                return False
+            if not os.path.isfile(out_file) or file_stat(out_file) != record['stat']:
+                return False
+            if sorted(record['inputs']) != sorted(set(inputs)):
+                return False
+            for in_file in inputs:
+                if not self.input_unchanged(in_file, record['inputs'][in_file]):
+                    return False
+        return True
+
+    @staticmethod
+    def input_unchanged(in_file, recorded):
+        """
+        Compares an input with its record: size and mtime first, the content hash only if these changed.
+        An input whose content is unchanged gets its record updated with the new mtime
+        """
+        if not os.path.isfile(in_file):
+            return False
+        stat = file_stat(in_file)
+        if stat == recorded['stat']:
+            return True
+        if stat['size'] != recorded['stat']['size'] or file_sha1(in_file) != recorded['sha1']:
+            return False
+        recorded['stat'] = stat
+        return True
+
+    def record(self, job):
+        """
+        Records the outputs of a job which has run successfully
+        """
+        inputs, outputs = job_files(job)
+        hashed = {}
+        for out_file in outputs:
+            for in_file, recorded in self.outputs.get(out_file, {}).get('inputs', {}).items():
+                if os.path.isfile(in_file) and file_stat(in_file) == recorded['stat']:
+                    hashed[in_file] = recorded
+        input_records = {}
+        for in_file in inputs:
+            if in_file not in hashed:
+                hashed[in_file] = {'stat': file_stat(in_file), 'sha1': file_sha1(in_file)}
+            input_records[in_file] = hashed[in_file]
+
+        params = job_params(job)
+        for out_file in outputs:
+            if os.path.isfile(out_file):
+                self.outputs[out_file] = {'params': params, 'version': metadata.__version__,
+                                          'stat': file_stat(out_file), 'inputs': input_records}
+
+    def save(self):
+        """
+        Writes the state file atomically
+        """
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        with atomic_open(self.state_file) as f:
+            json.dump({'outputs': self.outputs}, f, indent=1)
@@ -0,0 +1,325 @@
+"""
+Comparison of maps, i.e. to verify m -> nc -> m and nc -> m -> nc round trips or to measure how far scenarios differ
+
+Each pair of maps (m-maps and/or netCDF maps, in any combination) is read one timestep at a
+time as m-maps (NaN for cells without data) and compared cell by cell. Per pair, and per
+region of a region map (see aggregate.py), the statistics of b - a over all timesteps are:
+
+    compared        cells with data in both maps
+    changed         cells which differ by more than atol + rtol * |a|
+    mask_mismatch   cells with data in one map only
+    max_abs         maximum absolute difference
+    max_rel         maximum absolute difference relative to a (cells where a is 0 excluded)
+    rmse            root mean square difference
+
+Timesteps are matched by position. Multi-column maps are compared column by column.
+Pairs are compared on a process pool, and the statistics written to one .csv table.
+
+Usage:
+    python compare.py input/m/BFCellFrac.dat output/netcdf/BFCellFrac.nc
+    python compare.py scenarios/SSP1/output/m scenarios/SSP2/output/m --workers 8 --region-map countries
+    python compare.py --pairs pairs.json --summary compare_summary.csv
+
+Two directories are compared file by file (the files with the same name in both). The pairs
+file is a JSON or TOML file with a list of pairs, each with files 'a' and 'b' and optionally
+'name', 'var_a' and 'var_b' (variable of a netCDF map, the only data variable by default) and 'dim3_index':
+
+    {"pairs": [
+        {"name": "BFCellFrac round trip", "a": "input/m/BFCellFrac.dat", "b": "output/netcdf/BFCellFrac.nc"},
+        {"a": "SSP1/output/netcdf/Half_Earth.nc", "b": "SSP2/output/netcdf/Half_Earth.nc", "var_a": "layer", "var_b": "layer"}
+    ]}
+
+The exit status is 1 if any pair differs (changed cells or mask mismatches) or fails to compare.
+"""
+import os
+import sys
+import csv
+import argparse
+import functools
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import numpy.ma as ma
+import dirs
+from instrument import instrument
+import worker
+
+STATISTICS = ['compared', 'changed', 'mask_mismatch', 'max_abs', 'max_rel', 'rmse']
+
+# Region indices of the current process, loaded once per worker
+_indices = {}
+
+class MapSteps:
+    """
+    Timesteps of an m-map or a variable of a netCDF map, read one at a time as (NC,) or (NC, classes) m-maps,
+    NaN for cells without data. Maps without time dimension have one timestep
+
+    netCDF maps are read slice by slice. m-maps are parsed as a whole (pym), through the m-map cache.
+    """
+    def __init__(self, file_loc, mapping, var_name=None, dim3_index=None):
+        self.file_loc = file_loc
+        self.mapping = mapping
+        self.var_name = var_name
+        self.dim3_index = dim3_index
+        self.is_nc = file_loc.lower().endswith('.nc')
+
+    def __iter__(self):
+        if self.is_nc:
+            yield from self.iter_nc()
+        else:
+            yield from self.iter_mym()
+
+    def iter_mym(self):
+        from functions import single_timestep
+        from mcache import mym_cache
+
+        mmap = mym_cache.read_mym(os.path.basename(self.file_loc), path=dirs.path(os.path.dirname(self.file_loc)))
+        values = np.asarray(mmap[0]) if isinstance(mmap, tuple) else single_timestep(mmap, self.mapping)
+        if values.shape[1] != len(self.mapping):
+            raise ValueError("{} has {} cells, the mapping {}".format(self.file_loc, values.shape[1], len(self.mapping)))
+        for step in values:
+            yield step.astype(np.float64)
+
+    def iter_nc(self):
+        import netCDF4
+        from functions import nc2m
+        from outputs import nc_lock
+
+        converter = nc2m(None, None, None, False, None, self.dim3_index, None, 1, self.mapping)
+        with nc_lock, netCDF4.Dataset(self.file_loc) as nc_map:
+            converter.map_var = self.var_name or get_data_var(nc_map)
+            var_in = nc_map.variables[converter.map_var]
+            compressed = converter.get_compress_dim(nc_map, var_in) is not None
+            to_vector = converter.get_vector_reader(nc_map, var_in)
+            indices = [(t,) for t in range(len(var_in))] if 'time' in var_in.dimensions[:1] else [()]
+            for index in indices:
+                ncslice = ma.filled(converter.read_slice(var_in, index, np.float64), np.nan)
+                if compressed:
+                    yield to_vector(ncslice)
+                else:
+                    # (lat, lon, classes...) slice to (NC, classes...)
+                    yield np.moveaxis(self.mapping.gather(np.moveaxis(ncslice, (0, 1), (-2, -1))), -1, 0)
+
+def get_data_var(nc_map):
+    """
+    Returns the name of the only data variable of a netCDF map, i.e. the variable written by m2nc
+    """
+    data_vars = [name for name in nc_map.variables if name not in nc_map.dimensions]
+    if len(data_vars) != 1:
+        raise ValueError("No single data variable in {}: {}, select one by name".format(nc_map.filepath(), data_vars))
+    return data_vars[0]
+
+def diff_steps(a, b, codes, nbins, rtol=0., atol=0.):
+    """
+    Returns a dictionary of statistic -> (nbins,) array of the differences b - a of one timestep,
+    with sums (compared, changed, mask_mismatch, sum_sq) and maxima (max_abs, max_rel) per bin
+    a, b: (NC,) or (NC, classes) m-maps, NaN for cells without data
+    codes: bin of each m-map cell (i.e. RegionIndex.codes)
+    """
+    if a.shape != b.shape:
+        raise ValueError("Maps of shape {} and {} cannot be compared".format(a.shape, b.shape))
+    ncols = a.size // len(a)
+    bins = np.repeat(codes, ncols)
+    a, b = a.ravel(), b.ravel()
+
+    missing_a, missing_b = np.isnan(a), np.isnan(b)
+    both = ~(missing_a | missing_b)
+    abs_a = np.abs(np.where(both, a, 0.))
+    abs_diff = np.where(both, np.abs(b - a), 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rel_diff = np.where(abs_a > 0, abs_diff / abs_a, 0.)
+
+    def binsum(weights):
+        return np.bincount(bins, weights=weights, minlength=nbins)
+
+    def binmax(values):
+        out = np.zeros(nbins)
+        np.maximum.at(out, bins, values)
+        return out
+
+    return {
+        'compared': binsum(both),
+        'changed': binsum(abs_diff > atol + rtol * abs_a),
+        'mask_mismatch': binsum(missing_a != missing_b),
+        'sum_sq': binsum(abs_diff**2),
+        'max_abs': binmax(abs_diff),
+        'max_rel': binmax(rel_diff),
+    }
+
+def compare_maps(a, b, mapping, index=None, var_a=None, var_b=None, dim3_index=None, rtol=0., atol=0.):
+    """
+    Compares two maps timestep by timestep. Returns the number of timesteps of a and b, and a dictionary
+    of statistic -> array with the statistics over all timesteps per region of index (a RegionIndex, or None),
+    followed by the statistics of all cells
+    """
+    ncells = len(mapping)
+    if index is None:
+        codes, nregions = np.zeros(ncells, dtype=np.int64), 0
+    else:
+        codes, nregions = index.codes, len(index.regions)
+    nbins = nregions + 1                    # Last bin holds cells without region
+
+    steps_a = MapSteps(a, mapping, var_a, dim3_index)
+    steps_b = MapSteps(b, mapping, var_b, dim3_index)
+    totals = None
+    ntimes_a = ntimes_b = 0
+    iter_a, iter_b = iter(steps_a), iter(steps_b)
+    for step_a in iter_a:
+        ntimes_a += 1
+        step_b = next(iter_b, None)
+        if step_b is None:
+            continue
+        ntimes_b += 1
+        stats = diff_steps(step_a, step_b, codes, nbins, rtol, atol)
+        if totals is None:
+            totals = stats
+        else:
+            for name in ('compared', 'changed', 'mask_mismatch', 'sum_sq'):
+                totals[name] += stats[name]
+            totals['max_abs'] = np.maximum(totals['max_abs'], stats['max_abs'])
+            totals['max_rel'] = np.maximum(totals['max_rel'], stats['max_rel'])
+    ntimes_b += sum(1 for _ in iter_b)
+
+    if totals is None:
+        totals = {name: np.zeros(nbins) for name in ('compared', 'changed', 'mask_mismatch', 'sum_sq', 'max_abs', 'max_rel')}
+
+    # Regions, then all cells
+    sums = {name: np.append(totals[name][:nregions], totals[name].sum()) for name in ('compared', 'changed', 'mask_mismatch', 'sum_sq')}
+    maxima = {name: np.append(totals[name][:nregions], totals[name].max()) for name in ('max_abs', 'max_rel')}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmse = np.sqrt(sums['sum_sq'] / sums['compared'])
+    stats = {name: sums[name].astype(np.int64) for name in ('compared', 'changed', 'mask_mismatch')}
+    stats.update(maxima, rmse=rmse)
+    for name in ('max_abs', 'max_rel'):
+        stats[name][stats['compared'] == 0] = np.nan
+    return ntimes_a, ntimes_b, stats
+
+def get_region_index(region_map):
+    """
+    Returns the RegionIndex of a region map, loaded once per process
+    """
+    from aggregate import load_region_index
+    if region_map not in _indices:
+        _indices[region_map] = load_region_index(region_map, worker.mapping)
+    return _indices[region_map]
+
+def pair_name(pair):
+    return pair.get('name') or '{} vs {}'.format(pair['a'], pair['b'])
+
+def compare_pair(pair, region_map='region27', rtol=0., atol=0.):
+    """
+    Compares a pair of maps and returns its summary rows: the statistics over all cells (region 'all'),
+    followed by those per region of region_map (if any). A pair which fails to compare has one row with its error
+    """
+    row = {'name': pair_name(pair), 'a': pair['a'], 'b': pair['b']}
+    try:
+        with instrument.job(row['name'], 'compare'):
+            with instrument.stage('compare', "Comparing timesteps", read=[pair['a'], pair['b']]):
+                index = get_region_index(region_map) if region_map else None
+                ntimes_a, ntimes_b, stats = compare_maps(pair['a'], pair['b'], worker.mapping, index, pair.get('var_a'), pair.get('var_b'),
+                                                         pair.get('dim3_index'), rtol, atol)
+    except Exception:
+        instrument.log("\tFailed: {}".format(row['name']), 1)
+        return [dict(row, region='all', status='failed', error=traceback.format_exc())]
+
+    regions = list(index.regions) if index is not None else []
+    rows = []
+    for i, region in enumerate(['all'] + regions):
+        position = -1 if region == 'all' else i - 1
+        values = {name: stats[name][position].item() for name in STATISTICS}
+        differs = values['changed'] > 0 or values['mask_mismatch'] > 0 or ntimes_a != ntimes_b
+        rows.append(dict(row, region=region if region == 'all' else '{:g}'.format(region), timesteps_a=ntimes_a, timesteps_b=ntimes_b,
+                         status='differs' if differs else 'equal', error=None, **values))
+    return rows
+
+def compare_pairs(pairs, mapping, workers=1, region_map='region27', rtol=0., atol=0., verbosity=instrument.verbosity):
+    """
+    Compares all pairs, on a process pool if workers > 1, and returns their summary rows in order
+    """
+    if not pairs:
+        return []
+    run = functools.partial(compare_pair, region_map=region_map, rtol=rtol, atol=atol)
+    if workers <= 1:
+        worker.init_worker(mapping, verbosity)
+        results = [run(pair) for pair in pairs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pairs)), initializer=worker.init_worker, initargs=(mapping, verbosity, dirs.settings())) as pool:
+            results = list(pool.map(run, pairs))
+    return [row for rows in results for row in rows]
+
+def read_pairs(pairs_file):
+    """
+    Returns the list of pairs in a JSON or TOML pairs file
+    """
+    pairs = worker.read_entries(pairs_file, 'pairs')
+    for i, pair in enumerate(pairs):
+        if 'a' not in pair or 'b' not in pair:
+            raise ValueError("Pair {} in {} needs files 'a' and 'b'".format(i, pairs_file))
+    return pairs
+
+def dir_pairs(dir_a, dir_b, **fields):
+    """
+    Returns the pairs of files with the same name in two directories, with the other pair fields
+    """
+    names = sorted(set(os.listdir(dir_a)) & set(os.listdir(dir_b)))
+    return [dict(fields, name=name, a=os.path.join(dir_a, name), b=os.path.join(dir_b, name)) for name in names
+            if os.path.isfile(os.path.join(dir_a, name)) and os.path.isfile(os.path.join(dir_b, name))]
+
+def write_summary(rows, summary_file):
+    """
+    Writes the summary rows as .csv and prints the overall statistics of every pair
+    """
+    columns = ['name', 'region', 'status', 'timesteps_a', 'timesteps_b'] + STATISTICS + ['a', 'b', 'error']
+    with open(summary_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    for row in rows:
+        if row['region'] != 'all':
+            continue
+        if row['status'] == 'failed':
+            instrument.log("{:<8} {}".format(row['status'], row['name']), 1)
+        else:
+            instrument.log("{:<8} max_abs {:<10.4g} max_rel {:<10.4g} rmse {:<10.4g} changed {:<7} mask {:<7} {}".format(
+                row['status'], row['max_abs'], row['max_rel'], row['rmse'], row['changed'], row['mask_mismatch'], row['name']), 1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare pairs of maps (m-maps and/or netCDF maps) timestep by timestep")
+    parser.add_argument('a', nargs='?', help="Map or directory of maps")
+    parser.add_argument('b', nargs='?', help="Map or directory of maps to compare with a")
+    parser.add_argument('--pairs', help="JSON or TOML file with the pairs of maps to compare")
+    parser.add_argument('--var-a', help="Variable of netCDF map a (default: its only data variable)")
+    parser.add_argument('--var-b', help="Variable of netCDF map b (default: its only data variable)")
+    parser.add_argument('--dim3-index', type=int, help="Index of the 3rd dimension of the netCDF maps to compare")
+    parser.add_argument('--region-map', default='region27', help="Region map of the per-region statistics (region27, countries or none)")
+    parser.add_argument('--rtol', type=float, default=0., help="Relative tolerance of changed cells")
+    parser.add_argument('--atol', type=float, default=0., help="Absolute tolerance of changed cells")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--summary', default='compare_summary.csv', help="File to write the summary table to")
+    parser.add_argument('--root', help="Directory holding the data and cache directories (default: working directory)")
+    parser.add_argument('--verbosity', type=int, default=1, choices=range(4), help="0: quiet, 1: pairs, 2: stages, 3: stage timings")
+    args = parser.parse_args(argv)
+    instrument.verbosity = args.verbosity
+    if args.root:
+        dirs.configure(args.root)
+
+    fields = {'var_a': args.var_a, 'var_b': args.var_b, 'dim3_index': args.dim3_index}
+    if args.pairs:
+        pairs = read_pairs(args.pairs)
+    elif args.a and args.b and os.path.isdir(args.a) and os.path.isdir(args.b):
+        pairs = dir_pairs(args.a, args.b, **fields)
+    elif args.a and args.b:
+        pairs = [dict(fields, a=args.a, b=args.b)]
+    else:
+        parser.error("Give two maps, two directories or --pairs")
+
+    from api import get_mapping
+    region_map = None if args.region_map.lower() == 'none' else args.region_map
+    rows = compare_pairs(pairs, get_mapping(), args.workers, region_map, args.rtol, args.atol, args.verbosity)
+    write_summary(rows, args.summary)
+
+    return 1 if any(row['status'] != 'equal' for row in rows) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,95 @@
 # pylint: disable=missing-class-docstring
 """
 Input and Output directories
+
+Directories are relative to the working directory by default, and always end with the
+path separator of the platform. Use configure to place them elsewhere.
 """
+import os
+import hashlib
+import contextlib
+
+def path(*parts):
+    """
+    Directory path with a trailing separator, so that file names can be appended
+    """
+    return os.path.join(*parts, '')
+
 class InputDir:
-    data_dir = str("data\\")
-    m_in_dir = str("input\\m\\")
-    nc_in_dir = str("input\\netcdf\\")
-    list_in_dir = str("input\\country\\")
+    data_dir = path("data")
+    m_in_dir = path("input", "m")
+    nc_in_dir = path("input", "netcdf")
+    list_in_dir = path("input", "country")
 
 class OutputDir:
-    nc_out_dir = str("output\\netcdf\\")
-    m_out_dir = str("output\\m\\")
-    csv_out_dir = str("output\\csv\\")
-    
\ No newline at end of file
+    nc_out_dir = path("output", "netcdf")
+    m_out_dir = path("output", "m")
+    csv_out_dir = path("output", "csv")
+    bin_out_dir = path("output", "bin")
+    state_file = os.path.join("output", "build_state.json")
+    report_file = os.path.join("output", "run_report.json")
+    
+class CacheDir:
+    mapping_dir = path("cache", "mapping")
+    mym_dir = path("cache", "mym")
+    region_dir = path("cache", "region")
+
+def configure(root=None, **dirs):
+    """
+    Sets the input, output and cache directories
+        root: directory in which all relative directories are placed (i.e. a scenario folder)
+        dirs: individual directories by name, i.e. configure(nc_out_dir='/scratch/netcdf', data_dir='~/image/data')
+    """
+    for cls in (InputDir, OutputDir, CacheDir):
+        for name, value in list(vars(cls).items()):
+            if not name.endswith(('_dir', '_file')):
+                continue
+            if name in dirs:
+                value = os.path.expanduser(dirs.pop(name))
+            elif root is not None and not os.path.isabs(value):
+                value = os.path.join(os.path.expanduser(root), value)
+            else:
+                continue
+            setattr(cls, name, path(value) if name.endswith('_dir') else value)
+    if dirs:
+        raise ValueError("Unknown directories: {}".format(', '.join(dirs)))
+
+def settings():
+    """
+    All directories by name, i.e. to configure worker processes the same: configure(**settings())
+    """
+    return {name: value for cls in (InputDir, OutputDir, CacheDir)
+            for name, value in vars(cls).items() if name.endswith(('_dir', '_file'))}
+
+def file_sha1(file_loc):
+    """
+    Returns the sha1 hex digest of the content of a file, read in blocks
+    """
+    sha = hashlib.sha1()
+    with open(file_loc, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+@contextlib.contextmanager
+def atomic_open(file_loc, mode='w'):
+    """
+    Opens a temporary file which replaces file_loc once it is written and closed,
+    so that concurrent runs never read a partial file
+    """
+    tmp_file = file_loc + '.{}.tmp'.format(os.getpid())
+    try:
+        with open(tmp_file, mode) as f:
+            yield f
+        os.replace(tmp_file, file_loc)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def make_output_dirs():
+    """
+    Creates the output directories which do not exist yet
+    """
+    for name, value in vars(OutputDir).items():
+        if name.endswith('_dir'):
+            os.makedirs(value, exist_ok=True)
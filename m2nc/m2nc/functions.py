@@ -5,39 +5,18 @@ All functions are inside the m2nc class.
 
 Each instance of this class converts an m-map to a netCDFmap 
 """
-import netCDF4
 import numpy as np
 import numpy.ma as ma
-from pym import read_mym, load_mym, write_mym
+from concurrent.futures import ThreadPoolExecutor
 from dirs import InputDir, OutputDir
-from outputs import WriteMaps
-
-# Constants
-class Constants: 
-    NC = 66663
-    year_subset = [1, 30, 50, 80, 130]  # Indexes for years 1971, 2000, 2020, 2050, 2100
-    year_subset_27 = [0, 6, 10, 16, 26] # If map in 5 year increments to 2100 Indexes for years 1971, 2000, 2020, 2050, 2100
-    year_subset_17 = [0, 10, 16, 16]     # If map in 5 year incremets to 2050: Indexes for years 1971, 2000, 2020, 2050
-
-def get_mmapping(grdfile): 
-    """
-    Returns a list which links the rows of m-maps 
-    to an x,y coordinate based on the latutudes and longitudes in
-    a defining grdfile
-    """
-    nlats = 360
-    nlons = 720
-    lats = np.zeros(nlats)
-    lons = np.zeros(nlons)
-    lats[:] = 90. - (180./nlats)*np.arange(nlats) # north pole to south pole
-    lons[:] = -180. + (180./nlats)*np.arange(nlons) # 180degree longitude eastward
-
-    mapping = []
-    for i in range(len(grdfile)):   # per row
-        loc_lon = np.where(lons == grdfile[i,0])
-        loc_lat = np.where(lats == grdfile[i,1])
-        mapping.append([loc_lat[0].astype(np.int32), loc_lon[0].astype(np.int32)])
-    return mapping
+from outputs import WriteMaps, nc_lock
+from grid import Grid, regrid
+from timeaxis import LEGACY_SUBSETS, calendar_years, read_years, year_index
+from mcache import mym_cache
+from mwriter import write_mfile, write_csv, write_binary
+from instrument import instrument
+
+# netCDF4 and pym are imported where they are used, so that runs which do not need them start fast
 
 class m2nc:
     """
@@ -50,7 +29,7 @@ class m2nc:
     
     Then it  outputs it as a netCDF map, including relevant metadata.
     """
-    def __init__(self, mmap_in, map_title, map_var, map_unit, map_outname, timexist, mapping):
+    def __init__(self, mmap_in, map_title, map_var, map_unit, map_outname, timexist, mapping, nc_options=None, stream=True, out_res=None, regrid_how='mean', refine_how='copy', classes=None, layout='grid', years=None):
         self.mmap_in = mmap_in
         self.map_title = map_title
         self.map_var = map_var
@@ -58,6 +37,16 @@ class m2nc:
         self.map_outname = map_outname
         self.timexist = timexist
         self.mapping = mapping
+        self.nc_options = nc_options or {}   # Storage options of WriteMaps.maptime2nc (compression, dtype, chunking)
+        self.stream = stream                # Write maps with a time dimension one timestep at a time
+        self.out_grid = Grid.from_resolution(out_res) if out_res else mapping.grid   # Output grid, resolution in degrees
+        self.regrid_how = regrid_how        # Coarsening method in case the output grid is coarser than the mapping grid, see grid.regrid
+        self.refine_how = refine_how        # Refining method in case the output grid is finer than the mapping grid
+        self.classes = classes              # Class names (or {name: label}) of the columns of a multi-column m-map, see WriteMaps.create_nc
+        self.layout = layout                # 'grid': (lat, lon) maps, 'landpoint': only the m-map cells (CF compression by gathering)
+        self.years = years                  # Years to output (all years of the m-map by default), see select_timesteps
+        if layout == 'landpoint' and self.out_grid != mapping.grid:
+            raise ValueError("Land point output is only possible on the grid of the mapping ({})".format(mapping.grid))
 
     def run_m2nc(self):
         """
@@ -66,48 +55,227 @@ class m2nc:
         Second: Using the "mapping", m-maps are converted to grid
 
         Third: Output this grid as a netCDF file  
+
+        Multi-column m-maps (i.e. one column per crop) are written with their columns as the extra
+        dimension (dimension1) of the netCDF map, labelled by classes.
+
+        With the 'landpoint' layout the m-map rows are written as they are, along a land point
+        dimension, so no grid is created at all.
+
+        Only the timesteps of the selected years are converted, and dated by their year.
         """
-        print("\tReading in m-map")
-        if self.timexist:
-            self.mmap, self.time = read_mym(self.mmap_in, path= InputDir.m_in_dir)
-        else:
-            self.mmap = read_mym(self.mmap_in, path= InputDir.m_in_dir)
+        self.read()
+        self.convert()
+        self.write()
+
+    def read(self):
+        """
+        Reads in the m-map (first step of run_m2nc, see pipeline.py)
+        """
+        with instrument.stage('read', "Reading in m-map", read=[InputDir.m_in_dir + self.mmap_in]):
+            if self.timexist:
+                self.mmap, self.time = mym_cache.read_mym(self.mmap_in, path= InputDir.m_in_dir)
+            else:
+                self.mmap = single_timestep(mym_cache.read_mym(self.mmap_in, path= InputDir.m_in_dir), self.mapping)
+
+    def convert(self):
+        """
+        Converts the m-map to grid (second step of run_m2nc). Streamed and land point
+        outputs are converted while writing, one timestep at a time
+        """
+        self.gridmap = None
+        if self.layout == 'landpoint' or (self.timexist and self.stream):
+            return
 
         # Create map linking m-maps to lat/lon matrix
-        print("\tCreating gridded map")
-        gridmap = self.get_gridmap(self.mmap, self.mapping, self.timexist)
-        
-        # *** WRITE OUTPUT ***
-        print("\tWriting netCDF output")
-        writemap = WriteMaps(gridmap, self.map_title, self.map_var, self.map_unit, self.map_outname, self.timexist)
-        writemap.maptime2nc()
+        with instrument.stage('mapping', "Creating gridded map"):
+            self.gridmap = self.get_gridmap(cells_last(self.mmap, self.mapping), self.mapping, self.timexist)
+
+    def write(self):
+        """
+        Outputs the grid as a netCDF file (third step of run_m2nc), and releases the m-map and grid
+        """
+        nc_out = OutputDir.nc_out_dir + self.map_outname + '.nc'
+        mmap = cells_last(self.mmap, self.mapping)
+        dim1 = get_dim1(mmap, self.classes)
+
+        time_index, years = select_timesteps(self.time, self.years) if self.timexist else (None, None)
+
+        if self.layout == 'landpoint':
+            with instrument.stage('write', "Writing netCDF output (land points)", written=[nc_out]):
+                mmap = np.asarray(self.mmap)
+                writemap = WriteMaps(None if self.timexist else mmap[0], self.map_title, self.map_var, self.map_unit, self.map_outname, self.timexist, years)
+                if self.timexist:
+                    writemap.stream2nc((mmap[t] for t in time_index), (len(time_index),) + mmap.shape[1:], dim1, landpoints=self.mapping, **self.nc_options)
+                else:
+                    writemap.maptime2nc(dim1, landpoints=self.mapping, **self.nc_options)
+
+        elif self.timexist and self.stream:
+            # Convert and write one timestep at a time, holding only a single grid in memory
+            with instrument.stage('write', "Writing netCDF output per timestep", written=[nc_out]):
+                writemap = WriteMaps(None, self.map_title, self.map_var, self.map_unit, self.map_outname, self.timexist, years)
+                writemap.stream2nc(self.get_gridslices(mmap, self.mapping, time_index), (len(time_index),) + self.out_grid.shape + mmap.shape[1:-1], dim1, **self.nc_options)
+
+        else:
+            # *** WRITE OUTPUT ***
+            with instrument.stage('write', "Writing netCDF output", written=[nc_out]):
+                writemap = WriteMaps(self.gridmap, self.map_title, self.map_var, self.map_unit, self.map_outname, self.timexist, years)
+                writemap.maptime2nc(dim1, **self.nc_options)
+
+        self.mmap = self.gridmap = None
+
+    def get_gridslices(self, mmap, mapping, time_index=None):
+        """
+        Yields the grid of each timestep of the m-map (of the timesteps in time_index, all by default)
+
+        A single NaN grid is reused: only the m-map cells are overwritten each timestep,
+        so each grid must be consumed (i.e. written) before the next is requested.
+        Only the selected rows of the m-map are read (the cache memory-maps the m-map).
+        mmap: (time, (classes,) cells) m-map
+        """
+        if time_index is None:
+            time_index = range(len(mmap))
+        gridslice = mapping.scatter(mmap[time_index[0]])
+        for t in time_index:
+            mslice = mmap[t]
+            gridslice.reshape(gridslice.shape[:-2] + (-1,))[..., mapping.flat] = mslice
+            yield classes_last(regrid(gridslice, mapping.grid, self.out_grid, self.regrid_how, self.refine_how), mslice.ndim - 1)
 
     def get_gridmap(self, mmap, mapping, existtime):
         """
-        For each row in m-map get the required coordinates on an x,y grid 
+        Scatter each row in m-map to its x,y coordinates on a grid, for all timesteps at once
         
         The resultant gridmap is declared as an NaN grid, so that netCDF can automatically apply a mask.
+        mmap: (time, (classes,) cells) m-map
         """
+        nclass_axes = np.ndim(mmap) - 2
         if existtime:
-            gridmap = np.zeros((len(self.time), 360, 720)) * np.nan
-            for t in range(len(self.time)):
-                for i in range(len(mmap[0])):
-                    map_loc = mapping[i]
-                    gridmap[t,map_loc[0], map_loc[1]] = mmap[t][i]
-                
-            # Incase timesteps are missing:
-            if len(gridmap) < 27:
-                newtsteps = 27 - len(gridmap)
-                newtdata = np.zeros((newtsteps,360,720))
-                newtdata[:,:,:] = gridmap[0,:,:]
-                gridmap = np.insert(gridmap,0,newtdata,axis=0)
+            gridmap = mapping.scatter(np.asarray(mmap)[select_timesteps(self.time, self.years)[0]])
         else:
-            gridmap = np.zeros((360,720)) * np.nan
-            for i in range(len(mmap[0])):
-                map_loc = mapping[i]
-                gridmap[map_loc[0],map_loc[1]] = mmap[0][i]
+            gridmap = mapping.scatter(np.asarray(mmap)[0])
+
+        return classes_last(regrid(gridmap, mapping.grid, self.out_grid, self.regrid_how, self.refine_how), nclass_axes)
+
+def select_timesteps(time, years=None):
+    """
+    Returns the indices of the output timesteps in an m-map with years time, and their years:
+    all timesteps of the m-map, or those of the selected years. Years before the first
+    year of the m-map take its first timestep (i.e. to extend a map starting in 2020 back to 1970)
+    The years are None if the m-map timesteps are numbered instead of labelled by year
+    """
+    if years is None:
+        return list(range(len(time))), calendar_years(time)
+    return year_index(time, years, extend_first=True), list(years)
 
-        return gridmap
+def single_timestep(mmap, mapping):
+    """
+    Returns an m-map without time dimension as one timestep, (1, cells (, classes)):
+    pym reads such m-maps as one row, of which the first is taken, or as a vector of cells (cells (, classes))
+    """
+    mmap = np.asarray(mmap)
+    return mmap[np.newaxis] if len(mmap) == len(mapping) else mmap[:1]
+
+def cells_last(mmap, mapping):
+    """
+    Returns a (time, cells) or multi-column (time, cells, classes) m-map as (time, (classes,) cells),
+    so that all columns are scattered at once (a view, no copy)
+    """
+    mmap = np.asarray(mmap)
+    if mmap.ndim > 2 and mmap.shape[-1] != len(mapping):
+        return np.moveaxis(mmap, 1, -1)
+    return mmap
+
+def classes_last(gridmap, nclass_axes):
+    """
+    Moves the class axis of a gridded ((time,) classes, lat, lon) map after lat and lon, as in the netCDF output
+    """
+    if nclass_axes:
+        return np.moveaxis(gridmap, -3, -1)
+    return gridmap
+
+def get_dim1(mmap, classes=None):
+    """
+    Definition of the netCDF extra dimension (see WriteMaps.create_nc) of a (time, (classes,) cells) m-map:
+    'EMPTY' for single-column m-maps, otherwise classes (the number of columns by default)
+    """
+    if np.ndim(mmap) <= 2:
+        return 'EMPTY'
+    if classes is None:
+        return np.shape(mmap)[1]
+    if len(classes) != np.shape(mmap)[1]:
+        raise ValueError("{} classes given for an m-map with {} columns".format(len(classes), np.shape(mmap)[1]))
+    return classes
+
+class mmaps2nc:
+    """
+    Class which converts several m-maps to variables of a single netCDF map.
+
+    This class reads in a list of m-maps with the same cells and timesteps (i.e. the
+    emission factors of each crop), and the 'mapping' array which links each m-map row to a x,y coordinate
+
+    Subsequently, each timestep of all m-maps is converted to grids with a single scatter.
+
+    Then it outputs all grids as variables of one netCDF map, so metadata is computed
+    and the file is opened only once.
+    """
+    def __init__(self, mmaps_list, map_title, map_outname, timexist, mapping, nc_options=None, out_res=None, regrid_how='mean', refine_how='copy', classes=None, years=None):
+        self.mmaps_list = mmaps_list        # List of [1. m-map file name, 2. Variable Name, 3. Unit]
+        self.map_title = map_title
+        self.map_outname = map_outname
+        self.timexist = timexist
+        self.mapping = mapping
+        self.nc_options = nc_options or {}   # See m2nc
+        self.out_grid = Grid.from_resolution(out_res) if out_res else mapping.grid   # Output grid, resolution in degrees
+        self.regrid_how = regrid_how        # Coarsening method in case the output grid is coarser than the mapping grid, see grid.regrid
+        self.refine_how = refine_how        # Refining method in case the output grid is finer than the mapping grid
+        self.classes = classes              # Class names of multi-column m-maps, see m2nc
+        self.years = years                  # Years to output (all years of the m-maps by default), see select_timesteps
+
+    def run_mmaps2nc(self):
+        """
+        First: Read in all m-maps
+
+        Second: Using the "mapping", all m-maps are converted to grid, one timestep at a time
+
+        Third: Output the grids as variables of one netCDF file
+        """
+        mmaps = []
+        for mmap_in, map_var, map_unit in self.mmaps_list:
+            with instrument.stage('read', "Reading in m-map: {}".format(mmap_in), read=[InputDir.m_in_dir + mmap_in]):
+                if self.timexist:
+                    mmap, self.time = mym_cache.read_mym(mmap_in, path= InputDir.m_in_dir)
+                    mmap = cells_last(mmap, self.mapping)[:len(self.time)]
+                else:
+                    mmap = cells_last(single_timestep(mym_cache.read_mym(mmap_in, path= InputDir.m_in_dir), self.mapping), self.mapping)
+            if mmaps and mmap.shape != mmaps[0].shape:
+                raise ValueError("m-map {} has shape {}, expected {}".format(mmap_in, mmap.shape, mmaps[0].shape))
+            mmaps.append(mmap)
+
+        variables = [(map_var, map_var, map_unit) for mmap_in, map_var, map_unit in self.mmaps_list]
+        dim1 = get_dim1(mmaps[0], self.classes)
+        nclass_axes = mmaps[0].ndim - 2
+        nc_out = OutputDir.nc_out_dir + self.map_outname + '.nc'
+        writemap = WriteMaps(None, self.map_title, self.map_title, '-', self.map_outname, self.timexist)
+
+        with instrument.stage('write', "Writing netCDF output of {} m-maps".format(len(mmaps)), written=[nc_out]):
+            if self.timexist:
+                time_index, writemap.years = select_timesteps(self.time, self.years)
+                shape = (len(time_index),) + self.out_grid.shape + mmaps[0].shape[1:-1]
+                writemap.stream2nc(self.get_gridslices(mmaps, nclass_axes, time_index), shape, dim1, variables, **self.nc_options)
+            else:
+                writemap.outmap = next(self.get_gridslices(mmaps, nclass_axes)).copy()
+                writemap.maptime2nc(dim1, variables, **self.nc_options)
+
+    def get_gridslices(self, mmaps, nclass_axes, time_index=(0,)):
+        """
+        Yields the (variables, lat, lon (, classes)) grids of the timesteps in time_index of all m-maps,
+        scattered at once into a single reused NaN grid
+        """
+        gridslice = self.mapping.scatter(np.stack([mmap[time_index[0]] for mmap in mmaps]))
+        flat_view = gridslice.reshape(gridslice.shape[:-2] + (-1,))
+        for t in time_index:
+            flat_view[..., self.mapping.flat] = np.stack([mmap[t] for mmap in mmaps])
+            yield classes_last(regrid(gridslice, self.mapping.grid, self.out_grid, self.regrid_how, self.refine_how), nclass_axes)
 
 class nc2m:
     """
@@ -120,106 +288,372 @@ class nc2m:
     
     Then it  outputs it as an m-map.
     """
-    def __init__(self, ncmap_in, map_var, map_outname, timexist, timestep, dim3_index, comment, multiplier, mapping):
+    def __init__(self, ncmap_in, map_var, map_outname, timexist, timestep, dim3_index, comment, multiplier, mapping, mfile_writer='pym', side_output='npy', csv=False, regrid_how='mean', refine_how='copy', years=None):
         self.ncmap_in = ncmap_in
         self.map_var = map_var
         self.map_outname = map_outname
         self.timexist = timexist
         self.timestep = timestep
-        self.dim3_index = dim3_index
+        self.dim3_index = None if dim3_index is False else dim3_index     # Index of the 3rd dimension (class) to read, None or False for no selection
         self.comment = comment
         self.multiplier = multiplier
         self.mapping = mapping
+        self.mfile_writer = mfile_writer    # 'pym' or 'native' (mwriter.write_mfile)
+        self.side_output = side_output      # Binary side output: 'npy', 'parquet' or None
+        self.csv = csv                      # Also write a .csv output
+        self.regrid_how = regrid_how        # Coarsening method in case the nc-map grid is finer than the mapping grid, see grid.regrid
+        self.refine_how = refine_how        # Refining method in case the nc-map grid is coarser than the mapping grid
+        self.years = years                  # Years to read (all timesteps by default), see get_time_index
 
     def run_nc2m(self):
         """
-        First: Read in the nc-map
+        First: Read in the selected slices of the nc-map
 
-        Second: Using the "mapping", m-maps are converted to grid
+        Second: Using the "mapping", each slice is converted to a vector
 
-        Third: Output this grid as a netCDF file  
+        Third: Output the vectors as an m-map, and binary and/or .csv side outputs
         """
-        print("\tReading in nc-map")
-        self.ncmap_in = self.read_map(InputDir.nc_in_dir + self.ncmap_in, self.map_var) * self.multiplier
-
-        # Only take values for 1971, 2000, 2020, 2050 and 2100 if nc data is annual
-        if self.timexist and self.timestep == 132:
-            self.ncmap = np.take(self.ncmap_in, Constants.year_subset, axis=0)
-        elif self.timexist and self.timestep == 27:
-            self.ncmap = np.take(self.ncmap_in, Constants.year_subset_27, axis=0)
-        elif self.timexist and self.timestep == 17:
-            self.ncmap = np.take(self.ncmap_in, Constants.year_subset_17, axis=0)
-        else: 
-            self.ncmap = self.ncmap_in
-
-        # In case there is a 3rd dimension, and a filter has to be applied on it:
-        if self.dim3_index and self.timexist:
-            self.ncmap = self.ncmap[:,:,:,self.dim3_index]
-        elif self.dim3_index:
-            self.ncmap = self.ncmap[:,:,self.dim3_index]
-        else:
-            self.ncmap
+        self.read()
+        self.convert()
+        self.write()
 
-        # Create map linking m-maps to lat/lon matrix
-        print("\tCreating vector map")
-        vectormap = self.get_vectormap(self.ncmap, self.mapping, self.timexist)
-        
-        # *** WRITE OUTPUT ***
-        print("\tWriting m output")
-        if self.timexist:
-            timesteps=np.array(range(len(self.ncmap)))
-            write_mym(data=vectormap, years=timesteps, variable_name="data", filename=self.map_outname, path= OutputDir.m_out_dir, comment=self.comment)
+    def read(self):
+        """
+        Reads the selected slices of the nc-map, each converted to a vector (first step of run_nc2m, see pipeline.py)
+        """
+        # Read the nc-map slice by slice (only the selected years), and convert each slice to a vector
+        # The netCDF file is only partly read, so the bytes of the slices read are recorded (see read_slice)
+        with instrument.stage('read', "Reading in nc-map and creating vector map"):
+            self.vectormap = self.read_vectormap(InputDir.nc_in_dir + self.ncmap_in)
+
+    def convert(self):
+        """
+        Second step of run_nc2m: the vectors are already created while reading
+        The m-map timesteps are labelled by their year, or numbered if the nc-map has no time coordinate
+        """
+        self.timesteps = np.asarray(self.time) if self.timexist else None
+
+    def write(self):
+        """
+        Outputs the vectors as an m-map, and binary and/or .csv side outputs (third step of run_nc2m).
+        The outputs are written concurrently, each by its own thread
+        """
+        writes = [self.write_m_output]
+        if self.side_output:
+            writes.append(self.write_side_output)
+        if self.csv:
+            writes.append(self.write_csv_output)
+
+        if len(writes) == 1:
+            self.write_m_output()
         else:
-            write_mym(data=vectormap, variable_name="data", filename=self.map_outname, path= OutputDir.m_out_dir, comment=self.comment)
-        
+            with ThreadPoolExecutor(max_workers=len(writes)) as pool:
+                for future in [pool.submit(instrument.attached(write)) for write in writes]:
+                    future.result()
+        self.vectormap = None
+
+    def write_m_output(self):
+        vectormap, timesteps = self.vectormap, self.timesteps
+        with instrument.stage('write', "Writing m output", written=[OutputDir.m_out_dir + self.map_outname]):
+            if self.mfile_writer == 'native':
+                write_mfile(vectormap, self.map_outname, path= OutputDir.m_out_dir, years=timesteps, variable_name="data", comment=self.comment)
+                return
+            from pym import write_mym
+            if self.timexist:
+                write_mym(data=vectormap, years=timesteps, variable_name="data", filename=self.map_outname, path= OutputDir.m_out_dir, comment=self.comment)
+            else:
+                write_mym(data=vectormap, variable_name="data", filename=self.map_outname, path= OutputDir.m_out_dir, comment=self.comment)
+
+    def write_side_output(self):
+        bin_out = OutputDir.bin_out_dir + self.map_outname
+        with instrument.stage('write', "Writing {} output".format(self.side_output), written=[bin_out + '.npy', bin_out + '_years.npy', bin_out + '.parquet']):
+            write_binary(self.vectormap, bin_out, years=self.timesteps, kind=self.side_output)
+
+    def write_csv_output(self):
         # WRITING AS .csv
-        print("\tWriting .csv output")
-        np.savetxt(OutputDir.csv_out_dir+self.map_outname+'.csv', vectormap, delimiter=',')
+        with instrument.stage('write', "Writing .csv output", written=[OutputDir.csv_out_dir + self.map_outname + '.csv']):
+            write_csv(self.vectormap, OutputDir.csv_out_dir + self.map_outname + '.csv')
         
-    def read_map(self, file_loc, var_name, type='float32', maskvalue=-9999):
+    def read_vectormap(self, file_loc, time_index=None):
+        """
+        Returns the m-map (vector) of the variable in a netCDF file
+
+        Only the selected timesteps (time_index, by default those of the selected years, see get_time_index) and the 3rd dimension
+        index (if any) are read from disk, one timestep at a time, so that memory
+        scales with the selected slices rather than with the file.
+        """
+        import netCDF4
+        with nc_lock, netCDF4.Dataset(file_loc) as nc_map:
+            return self.read_dataset(nc_map, time_index)
+
+    def read_dataset(self, nc_map, time_index=None):
+        """
+        Returns the m-map (vector) of the variable in an open netCDF dataset, see read_vectormap
+        The years (or timestep numbers) of the timesteps read are stored in self.time
+        """
+        with nc_lock:
+            var_in = nc_map.variables[self.map_var]
+            to_vector = self.get_vector_reader(nc_map, var_in)
+            read_type = self.get_read_type(nc_map, var_in)
+            if self.timexist:
+                nc_years = read_years(nc_map)
+                if time_index is None:
+                    time_index, self.time = self.get_time_index(nc_years, len(var_in))
+                else:
+                    self.time = [nc_years[t] for t in time_index] if nc_years is not None else list(time_index)
+                vectormap = np.zeros((len(time_index), len(self.mapping)))
+                for t_out, t_in in enumerate(time_index):
+                    vectormap[t_out] = to_vector(self.read_slice(var_in, (t_in,), read_type))
+                vectormap[np.isnan(vectormap)] = 0
+            else:
+                vectormap = to_vector(self.read_slice(var_in, (), read_type))
+        return vectormap
+
+    def get_time_index(self, nc_years, ntimes):
+        """
+        Returns the indices of the timesteps to read, of the years selected by self.years (all by default),
+        and their years (timestep numbers if unknown)
+        nc_years: years of the time coordinate of the nc-map (see timeaxis.read_years), None if it has none
+
+        The timestep setting selects the years of the layouts in timeaxis.LEGACY_SUBSETS,
+        assuming the years of the layout if the nc-map has no time coordinate.
+        """
+        if self.years is not None:
+            if nc_years is None:
+                raise ValueError("{} has no time coordinate with years, select timesteps by index instead".format(self.map_var))
+            return year_index(nc_years, self.years), list(self.years)
+        if self.timestep in LEGACY_SUBSETS:
+            layout_years, years = LEGACY_SUBSETS[self.timestep]
+            return year_index(nc_years if nc_years is not None else layout_years, years), list(years)
+        if nc_years is None:
+            return list(range(ntimes)), list(range(ntimes))
+        return list(range(ntimes)), list(nc_years)
+
+    def get_vector_reader(self, nc_map, var_in):
+        """
+        Returns the function which converts a slice of var_in to a vector (m-map):
+            - gridded maps: gather of the mapping cells (see get_vectormap)
+            - land point maps (CF compression by gathering): a plain copy if the land points are the
+              cells of the mapping, in the same order (i.e. written by m2nc), otherwise a lookup
+        """
+        compress_dim = self.get_compress_dim(nc_map, var_in)
+        if compress_dim is None:
+            return lambda ncslice: self.get_vectormap(ncslice, self.mapping, False)
+
+        grid_shape = tuple(len(nc_map.dimensions[dim]) for dim in nc_map.variables[compress_dim].compress.split())
+        if grid_shape != self.mapping.shape:
+            raise ValueError("Land points of {} are on a {} grid, the mapping on {}".format(self.map_var, grid_shape, self.mapping.shape))
+        landpoints = nc_map.variables[compress_dim][:]
+        if np.array_equal(landpoints, self.mapping.flat):
+            return lambda ncslice: ma.getdata(ncslice).astype(np.float64)
+
+        # Position of each mapping cell in the land points, the last position (NaN) if it is not a land point
+        lookup = np.full(np.prod(grid_shape), len(landpoints), dtype=np.int64)
+        lookup[landpoints] = np.arange(len(landpoints))
+        position = lookup[self.mapping.flat]
+        return lambda ncslice: np.append(ma.getdata(ncslice).astype(np.float64), np.nan)[position]
+
+    def get_read_type(self, nc_map, var_in):
+        """
+        Returns the dtype in which slices of var_in are read: float32 for gridded maps (as before),
+        None (the stored dtype) for land point and float64 maps, so that these are copied exactly
+        """
+        if var_in.dtype == np.float64 or self.get_compress_dim(nc_map, var_in) is not None:
+            return None
+        return 'float32'
+
+    @staticmethod
+    def get_compress_dim(nc_map, var_in):
+        """
+        Returns the dimension of var_in which is compressed by gathering (its coordinate variable has a
+        'compress' attribute), None if the variable is gridded
+        """
+        for dim in var_in.dimensions:
+            if dim in nc_map.variables and 'compress' in nc_map.variables[dim].ncattrs():
+                return dim
+        return None
+
+    def read_slice(self, var_in, index, type='float32'):
+        """
+        Returns a masked (lat, lon) or (landpoint,) slice of a netCDF variable, multiplied by the multiplier
+        index: tuple with the leading (time) index, empty if there is no time dimension
+        type: dtype of the slice, None for the stored dtype (see get_read_type)
+
+        If the nc-map is on another grid than the mapping (i.e. 5 arcminute or 1 degree),
+        the slice is regridded, with masked cells ignored (NaN).
+        """
+        # In case there is a 3rd dimension, and a filter has to be applied on it (after lat, lon or landpoint):
+        if self.dim3_index is not None:
+            index = index + (slice(None),) * (var_in.ndim - len(index) - 1) + (self.dim3_index,)
+        ncslice = var_in[index] if index else var_in[:]
+        instrument.count_read(ncslice.size * var_in.dtype.itemsize)
+        ncslice = self.mask_map(ncslice, type) * self.multiplier
+        if ncslice.ndim == 2 and ncslice.shape != self.mapping.shape:
+            ncslice = regrid(ma.filled(ncslice.astype(np.float64), np.nan), Grid(*ncslice.shape), self.mapping.grid, self.regrid_how, self.refine_how)
+        return ncslice
+
+    @staticmethod
+    def read_map(file_loc, var_name, type='float32', maskvalue=-9999, index=Ellipsis):
         """
         Returns a numpy array of the variable in a netCDF file
         Inputs:
         1. netCDF File 
         2. Variable name
-        3. Data type of output. float64 by default
+        3. Data type of output. float32 by default, None for the stored dtype
         4. Mask value: -9999 by default
+        5. Index of the variable to read (netCDF slicing). Whole variable by default
 
         Output:
         Masked numpy array of correct dtype and mask fill_value
+        """
+        import netCDF4
+        with nc_lock, netCDF4.Dataset(file_loc) as nc_map:
+            return nc2m.mask_map(nc_map.variables[var_name][index], type, maskvalue)
+
+    @staticmethod
+    def mask_map(var_in, type='float32', maskvalue=-9999):
+        """
+        Returns a masked array of correct dtype, in which both the netCDF fill values
+        and the mask value are masked
 
         Comment:
         Have to store a pre-corrected version of the map
         because the fill_value changes during operations.
         This is a numpy bug, see: https://github.com/numpy/numpy/issues/3762
         """
-        nc_map = netCDF4.Dataset(file_loc)
-        var_in = nc_map.variables[var_name][:]
+        var_in = ma.asarray(var_in)
         var_array = np.array(var_in, dtype=type)
         var_array = np.ma.masked_where(var_in == var_in.fill_value, var_array)
         var_array = ma.masked_values(var_array, maskvalue)
         
         return var_array
 
-    def get_vectormap(self, ncmap, mapping, existtime):
+    @staticmethod
+    def get_vectormap(ncmap, mapping, existtime):
             """
-            For each row in m-map get the required coordinates on an x,y grid 
-            
-            Lookup ncmap value at these coordinates, and assign to vectormap row
+            For each row in m-map lookup the ncmap value at its x,y coordinates,
+            for all timesteps at once
             
-            The resultant gridmap is declared as an NaN grid, so that netCDF can automatically apply a mask.
+            Masked cells keep their underlying data. NaN values are set to 0 if there is a time dimension.
             """
+            vectormap = mapping.gather(ma.getdata(ncmap)).astype(np.float64, copy=False)
             if existtime:
-                vectormap = np.zeros((len(self.ncmap), Constants.NC))
-                for t in range(len(self.ncmap)):
-                    print("\t\ttimestep: ", t)
-                    for i in range(Constants.NC):
-                        map_loc = mapping[i]
-                        vectormap[t,i] = ncmap[t,map_loc[0], map_loc[1]].data
-                        vectormap[np.isnan(vectormap)] = 0
-            else:
-                vectormap = np.zeros(Constants.NC)
-                for i in range(Constants.NC):
-                    map_loc = mapping[i]
-                    vectormap[i] = ncmap[map_loc[0], map_loc[1]].data
+                vectormap[np.isnan(vectormap)] = 0
             return vectormap
+
+
+def join_list(idmap, ids, values):
+    """
+    Returns gridded maps of listed values, by joining the IDs of a gridded ID-map 
+    (i.e. countries_grid.nc) to the IDs of a list
+    Inputs:
+    1. Masked 2D array of IDs
+    2. 1D array with the ID of each list row
+    3. 2D array of listed values (list rows, variables)
+
+    Output:
+    Masked array (variables, lat, lon), an array of IDs on the map which are missing from the list,
+    and an array of the list rows without ID (blank or not a number), which are ignored
+
+    Comment:
+    A dense ID -> list row lookup array is built once, so that all cells of all
+    variables are assigned with a single vectorized take.
+    Cells which are masked on the ID-map, or whose ID is missing from the list, are masked.
+    """
+    idmap = ma.asarray(idmap)
+    cells = ~ma.getmaskarray(idmap).ravel()
+    cell_ids = np.rint(ma.getdata(idmap).ravel()[cells]).astype(np.int64)
+    ids = np.asarray(ids, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).reshape(len(ids), -1)
+    listed = np.isfinite(ids)
+    blank_rows = np.flatnonzero(~listed)
+    ids, values = np.rint(ids[listed]).astype(np.int64), values[listed]
+
+    # Lookup array from ID to list row. If an ID is listed twice, the first row is used
+    all_ids = np.concatenate((ids, cell_ids))
+    id_min = all_ids.min() if len(all_ids) else 0
+    lookup = np.full((all_ids.max() - id_min + 1) if len(all_ids) else 0, len(ids), dtype=np.int64)
+    lookup[ids[::-1] - id_min] = np.arange(len(ids))[::-1]
+
+    rows = lookup[cell_ids - id_min]
+    found = rows < len(ids)
+    missing_ids = np.unique(cell_ids[~found])
+
+    # Extra row holding the fill value, for IDs which are missing from the list
+    values = np.vstack((values, np.full((1, values.shape[1]), idmap.fill_value)))
+
+    gridmaps = np.full((values.shape[1], cells.size), idmap.fill_value, dtype=np.float64)
+    gridmaps[:, cells] = values[rows].T
+    mask = np.ones(cells.size, dtype=bool)
+    mask[np.flatnonzero(cells)[found]] = False
+    mask = np.broadcast_to(mask, gridmaps.shape)
+
+    gridmaps = ma.masked_array(gridmaps, mask=mask, fill_value=idmap.fill_value)
+    return gridmaps.reshape((values.shape[1],) + idmap.shape), missing_ids, blank_rows
+
+class list2map:
+    """
+    Class which converts listed data (i.e. country data in excel) to m-maps and netCDF maps.
+
+    This class reads in a list (excel or .csv) with an ID column, and a netCDF ID-map
+    (i.e. countries_grid.nc or region27.nc) which holds the ID of each grid cell.
+    It also reads in a 'mapping' array which links each m-map row to a x,y coordinate
+
+    Subsequently, all requested columns of the list are joined to the ID-map at once.
+
+    Then it outputs each column as a netCDF map and/or an m-map.
+    """
+    def __init__(self, list_in, sheet_name, header, id_col, idmap_in, idmap_var, mapping, nc_options=None):
+        self.list_in = list_in
+        self.sheet_name = sheet_name
+        self.header = header
+        self.id_col = id_col
+        self.idmap_in = idmap_in
+        self.idmap_var = idmap_var
+        self.mapping = mapping
+        self.nc_options = nc_options or {}   # See m2nc
+
+    def run_list2map(self, maps_list, tonc, tom):
+        """
+        First: Read in the nc ID-map and the listed data
+
+        Second: Join all listed columns to the ID-map
+
+        Third: Output each column as a netCDF file and/or m-map
+
+        maps_list: list of [1. Column (Variable Name), 2. Map Title, 3. Unit, 4. Output Name, 5. M-file header comment]
+        """
+        with instrument.stage('read', "Reading in nc ID-map", read=[InputDir.data_dir + self.idmap_in]):
+            idmap = nc2m.read_map(InputDir.data_dir + self.idmap_in, self.idmap_var)
+
+        with instrument.stage('read', "Reading in listed data", read=[InputDir.list_in_dir + self.list_in]):
+            list_df = self.read_list()
+
+        with instrument.stage('mapping', "Assigning listed data to gridded map"):
+            map_cols = [outmap[0] for outmap in maps_list]
+            gridmaps, missing_ids, blank_rows = join_list(idmap, list_df[self.id_col].to_numpy(), list_df[map_cols].to_numpy())
+        if len(missing_ids):
+            instrument.log("\tIDs missing from listed data (masked): {}".format(missing_ids), 1)
+        if len(blank_rows):
+            instrument.log("\tRows of listed data without ID (ignored): {}".format(list_df.index[blank_rows].tolist()), 1)
+
+        for outmap, gridmap in zip(maps_list, gridmaps):
+            if tonc:
+                with instrument.stage('write', "Writing netCDF output: {}".format(outmap[3]), written=[OutputDir.nc_out_dir + outmap[3] + '.nc']):
+                    writemap = WriteMaps(gridmap, outmap[1], outmap[0], outmap[2], outmap[3], False)
+                    writemap.maptime2nc(**self.nc_options)
+
+            if tom:
+                from pym import write_mym
+                with instrument.stage('write', "Writing m output: {}".format(outmap[3]), written=[OutputDir.m_out_dir + outmap[3]]):
+                    vectormap = nc2m.get_vectormap(gridmap, self.mapping, False)
+                    write_mym(data=vectormap, variable_name=outmap[0], filename=outmap[3], path= OutputDir.m_out_dir, comment=outmap[4])
+
+    def read_list(self):
+        """
+        Returns a DataFrame of the listed data, from an excel sheet or a .csv file
+        """
+        import pandas as pd
+        if self.list_in.lower().endswith('.csv'):
+            return pd.read_csv(InputDir.list_in_dir + self.list_in, header=self.header)
+        return pd.read_excel(InputDir.list_in_dir + self.list_in, sheet_name=self.sheet_name, header=self.header)
@@ -0,0 +1,152 @@
+"""
+Regular lat/lon grids and block regridding between them
+
+Grids are described by their number of latitudes and longitudes. Rows run from
+the north pole southward and columns eastward from 180 degrees west, with the
+coordinates of a cell as in mcoord.txt (90 - res*row, -180 + res*col).
+
+Regridding between grids whose resolutions differ by an integer factor is done
+with reshape-reductions over blocks of cells:
+    - coarsen: sum, mean, area_mean (area-weighted mean) or mode (categorical maps, i.e. GNLCT_30MIN)
+    - refine: copy (intensive or categorical values), split (extensive values, equally) or area (extensive values, by cell area)
+"""
+import numpy as np
+
+EARTH_RADIUS = 6371.0   # km
+
+class Grid:
+    """
+    Regular lat/lon grid of nlats x nlons cells
+    """
+    def __init__(self, nlats, nlons=None):
+        self.nlats = int(nlats)
+        self.nlons = int(nlons) if nlons is not None else 2*self.nlats
+        self.resolution = 180. / self.nlats
+
+    @classmethod
+    def from_resolution(cls, resolution):
+        """
+        Returns the global grid with a resolution in degrees (i.e. 0.5, 1, 1/12)
+        """
+        return cls(int(round(180. / resolution)), int(round(360. / resolution)))
+
+    @property
+    def shape(self):
+        return (self.nlats, self.nlons)
+
+    @property
+    def lats(self):
+        return 90. - self.resolution*np.arange(self.nlats) # north pole to south pole
+
+    @property
+    def lons(self):
+        return -180. + self.resolution*np.arange(self.nlons) # 180degree longitude eastward
+
+    def cell_area(self):
+        """
+        Returns the (nlats, nlons) area of each cell in km^2, on a spherical earth
+        """
+        edges = np.radians(90. - self.resolution*np.arange(self.nlats + 1))
+        row_area = EARTH_RADIUS**2 * np.radians(self.resolution) * (np.sin(edges[:-1]) - np.sin(edges[1:]))
+        return np.repeat(row_area[:, np.newaxis], self.nlons, axis=1)
+
+    def __eq__(self, other):
+        return isinstance(other, Grid) and self.shape == other.shape
+
+    def __hash__(self):
+        return hash(self.shape)
+
+    def __repr__(self):
+        return "Grid({}, {})".format(self.nlats, self.nlons)
+
+HALF_DEGREE = Grid(360, 720)        # IMAGE 30 arcminute grid
+FIVE_MINUTE = Grid(2160, 4320)      # IMAGE-LPJmL 5 arcminute grid
+ONE_DEGREE = Grid(180, 360)
+
+def get_factor(fine, coarse):
+    """
+    Integer factor between the resolutions of a fine and a coarse grid
+    """
+    factor = fine.nlats // coarse.nlats
+    if factor * coarse.nlats != fine.nlats or factor * coarse.nlons != fine.nlons:
+        raise ValueError("{} and {} do not differ by an integer factor".format(fine, coarse))
+    return factor
+
+def to_blocks(gridmap, factor):
+    """
+    Returns a view of (..., lat, lon) as (..., lat/factor, lon/factor, factor*factor) blocks
+    """
+    *lead, nlats, nlons = gridmap.shape
+    blocks = gridmap.reshape(tuple(lead) + (nlats // factor, factor, nlons // factor, factor))
+    blocks = np.moveaxis(blocks, -3, -2)
+    return blocks.reshape(tuple(lead) + (nlats // factor, nlons // factor, factor*factor))
+
+def coarsen(gridmap, factor, how='mean', area=None):
+    """
+    Aggregates blocks of factor x factor cells of a (..., lat, lon) map. NaN cells are ignored,
+    blocks without data are NaN
+        how: sum, mean, area_mean (requires the (lat, lon) area of the fine cells) or mode
+    """
+    gridmap = np.asarray(gridmap, dtype=np.float64)
+    blocks = to_blocks(gridmap, factor)
+    valid = ~np.isnan(blocks)
+    has_data = valid.any(axis=-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if how == 'sum':
+            result = np.where(valid, blocks, 0.).sum(axis=-1)
+        elif how == 'mean':
+            result = np.where(valid, blocks, 0.).sum(axis=-1) / valid.sum(axis=-1)
+        elif how == 'area_mean':
+            weights = np.where(valid, to_blocks(np.asarray(area, dtype=np.float64), factor), 0.)
+            result = (np.where(valid, blocks, 0.) * weights).sum(axis=-1) / weights.sum(axis=-1)
+        elif how == 'mode':
+            result = block_mode(blocks)
+        else:
+            raise ValueError("Unknown coarsening method: {}".format(how))
+
+    return np.where(has_data, result, np.nan)
+
+def block_mode(blocks):
+    """
+    Most frequent value of each block (last axis), the smallest value in case of ties.
+    NaN values are never the mode unless the block has no data.
+    """
+    values = np.sort(blocks, axis=-1)           # NaN sorts last
+    position = np.arange(values.shape[-1])
+    new_run = np.ones(values.shape, dtype=bool)
+    new_run[..., 1:] = values[..., 1:] != values[..., :-1]
+    run_start = np.maximum.accumulate(np.where(new_run, position, 0), axis=-1)
+    run_length = np.where(np.isnan(values), 0, position - run_start + 1)
+    return np.take_along_axis(values, np.argmax(run_length, axis=-1)[..., np.newaxis], axis=-1)[..., 0]
+
+def refine(gridmap, factor, how='copy', area=None):
+    """
+    Disaggregates each cell of a (..., lat, lon) map to factor x factor cells
+        how: copy (same value in every cell), split (value divided equally),
+             area (value divided by the area share of each fine cell, requires the (lat, lon) area of the fine cells)
+    """
+    gridmap = np.asarray(gridmap)
+    fine = np.repeat(np.repeat(gridmap, factor, axis=-2), factor, axis=-1)
+    if how == 'copy':
+        return fine
+    if how == 'split':
+        return fine / factor**2
+    if how == 'area':
+        area = np.asarray(area, dtype=np.float64)
+        share = area / np.repeat(np.repeat(to_blocks(area, factor).sum(axis=-1), factor, axis=-2), factor, axis=-1)
+        return fine * share
+    raise ValueError("Unknown refining method: {}".format(how))
+
+def regrid(gridmap, source, target, how='mean', refine_how='copy'):
+    """
+    Regrids a (..., lat, lon) map from a source to a target Grid
+        how: coarsening method, used if target is coarser (see coarsen)
+        refine_how: refining method, used if target is finer (see refine)
+        (area-weighted methods use the cell area of the finer grid)
+    """
+    if source == target:
+        return gridmap
+    if source.nlats > target.nlats:
+        return coarsen(gridmap, get_factor(source, target), how, source.cell_area() if how == 'area_mean' else None)
+    return refine(gridmap, get_factor(target, source), refine_how, target.cell_area() if refine_how == 'area' else None)
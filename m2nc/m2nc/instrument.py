@@ -0,0 +1,165 @@
+"""
+Lightweight instrumentation of the conversion stages
+
+Each conversion is recorded as a job, made up of stages (read, mapping, write, metadata).
+For every stage the wall time and the bytes read/written (size of the files involved,
+or of the slices read from partly read files, see count_read) are recorded, and for every job its wall time and the peak RSS of the process so far.
+Jobs may be run by several threads (see pipeline.py): the current job is kept per
+thread, and a thread works on a job's record by attaching to it.
+Progress messages are printed depending on the verbosity:
+    0: quiet
+    1: one line per job
+    2: one line per stage (default)
+    3: stage timings
+"""
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, None if it cannot be determined (i.e. on Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / 1024**2 if sys.platform == 'darwin' else peak / 1024, 1)
+
+def file_bytes(files):
+    """
+    Total size of those files which exist
+    """
+    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+
+class Instrument:
+    """
+    Records jobs and their stages, and prints progress depending on verbosity
+    """
+    def __init__(self, verbosity=2):
+        self.verbosity = verbosity
+        self.jobs = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        """
+        Record of the job the current thread works on, None if there is none
+        """
+        return getattr(self._local, 'current', None)
+
+    @current.setter
+    def current(self, record):
+        self._local.current = record
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            print(message)
+
+    @contextlib.contextmanager
+    def job(self, name, kind):
+        """
+        Records a job (conversion of one map) with all stages run inside it
+        """
+        record = self.start_job(name, kind)
+        try:
+            with self.attach(record):
+                yield record
+        finally:
+            self.end_job(record)
+
+    def start_job(self, name, kind):
+        """
+        Starts the record of a job whose stages may run in several threads, see attach. Ended by end_job
+        """
+        self.log("Processing Map: {}".format(name), 1)
+        return {'name': name, 'type': kind, 'stages': [], 'bytes_read': 0, 'bytes_written': 0, '_start': time.perf_counter()}
+
+    def end_job(self, record):
+        record['seconds'] = round(time.perf_counter() - record.pop('_start'), 4)
+        record['peak_rss_mb'] = peak_rss_mb()
+        with self._lock:
+            self.jobs.append(record)
+        self.log("\tdone in {:.3f}s".format(record['seconds']), 3)
+
+    @contextlib.contextmanager
+    def attach(self, record):
+        """
+        Records the stages run by the current thread in the job of record
+        """
+        parent, self.current = self.current, record
+        try:
+            yield record
+        finally:
+            self.current = parent
+
+    def attached(self, func):
+        """
+        Returns func, to be run in another thread, with the stages it runs recorded in the current job
+        """
+        record = self.current
+        def run_attached(*args, **kwargs):
+            with self.attach(record):
+                return func(*args, **kwargs)
+        return run_attached
+
+    @contextlib.contextmanager
+    def stage(self, name, message=None, read=(), written=()):
+        """
+        Records a stage of the current job
+            name: read, mapping, write or metadata
+            message: progress message
+            read, written: files read/written in this stage, whose size is recorded
+        """
+        if message:
+            self.log("\t" + message, 2)
+        parent, self._local.sliced = getattr(self._local, 'sliced', None), [0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            sliced, self._local.sliced = self._local.sliced[0], parent
+            record = self.current
+            if record is not None:
+                stage = {'stage': name, 'seconds': round(seconds, 4), 'bytes_read': file_bytes(read) + sliced, 'bytes_written': file_bytes(written)}
+                with self._lock:
+                    record['stages'].append(stage)
+                    record['bytes_read'] += stage['bytes_read']
+                    record['bytes_written'] += stage['bytes_written']
+            self.log("\t\t{}: {:.3f}s".format(name, seconds), 3)
+
+    def count_read(self, nbytes):
+        """
+        Adds nbytes to the bytes read by the current stage of this thread, i.e. the size of
+        the slices read from a file which is only partly read
+        """
+        sliced = getattr(self._local, 'sliced', None)
+        if sliced is not None:
+            sliced[0] += int(nbytes)
+
+    def report(self):
+        """
+        Returns the records of all jobs, and their totals
+        """
+        return {'jobs': self.jobs,
+                'seconds': round(sum(job['seconds'] for job in self.jobs), 4),
+                'bytes_read': sum(job['bytes_read'] for job in self.jobs),
+                'bytes_written': sum(job['bytes_written'] for job in self.jobs),
+                'peak_rss_mb': peak_rss_mb()}
+
+    def write_report(self, file_loc):
+        """
+        Writes the report of all jobs as JSON (see report)
+        """
+        with open(file_loc, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+# Instrument used by all conversions of this process
+instrument = Instrument()
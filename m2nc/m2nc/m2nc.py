@@ -6,19 +6,20 @@ Date:   April 2021: m2nc functionality
         July 2021: Added nc2m functionality
         November 2021: Added list2map (m&netCDF) functionality
 """
-import numpy as np
 from flags import RunFunction
-from functions import m2nc, nc2m, get_mmapping
-from dirs import InputDir, OutputDir
+from functions import m2nc, mmaps2nc, nc2m, list2map
+from api import get_mapping
+from dirs import OutputDir, make_output_dirs
+from instrument import instrument
 
 
 def main(run):
     # File identifying grid coordinates of m-map, needed to create m-2-grid mapping
-    grdfile  = np.loadtxt(InputDir.data_dir + 'mcoord.txt')
-    mapping = get_mmapping(grdfile)
+    mapping = get_mapping()
+    make_output_dirs()
 
     if run.m2nc:
-        print("\n***Running m2nc***")
+        instrument.log("\n***Running m2nc***", 1)
         # List of maps to convert from m to nc
             # Create list of maps to be outputted with the following information:
             # 1. m-map file name, 2. Map Title, 3. Variable Name, 4. Unit, 5. Output Name, 6. Has time dimension (boolean)
@@ -35,14 +36,27 @@ def main(run):
                     ]
                     
         for outmap in m2nc_maps_list:
-            print("Processing Map: ", outmap[1])
-            write_m2nc = m2nc(outmap[0], outmap[1], outmap[2], outmap[3], outmap[4], outmap[5], mapping)
-            write_m2nc.run_m2nc() 
+            with instrument.job(outmap[1], 'm2nc'):
+                write_m2nc = m2nc(outmap[0], outmap[1], outmap[2], outmap[3], outmap[4], outmap[5], mapping)
+                write_m2nc.run_m2nc() 
+
+        # List of m-maps to combine as variables of a single netCDF map
+            # 1. List of [m-map file name, Variable Name, Unit], 2. Map Title, 3. Output Name, 4. Has time dimension (boolean)
+        mmaps2nc_maps_list = [
+                    #[[['nw_EmisType2ST_pkm.out','NWOOD_EF_Gradual','kgCO2/km^2'],['wd_EmisType2ST_pkm.out','WOODY_EF_Gradual','kgCO2/km^2'],
+                    #  ['sc_EmisType2ST_pkm.out','SUGAR_EF_Gradual','kgCO2/km^2'],['mz_EmisType2ST_pkm.out','MAIZE_EF_Gradual','kgCO2/km^2'],
+                    #  ['oc_EmisType2ST_pkm.out','OILCR_EF_Gradual','kgCO2/km^2']],'Gradual Emission Factors','EF_Gradual',False],
+                    ]
+
+        for outmaps in mmaps2nc_maps_list:
+            with instrument.job(outmaps[1], 'mmaps'):
+                write_mmaps2nc = mmaps2nc(outmaps[0], outmaps[1], outmaps[2], outmaps[3], mapping)
+                write_mmaps2nc.run_mmaps2nc()
 
     if run.nc2m:
-        print("\n***Running nc2m***")
+        instrument.log("\n***Running nc2m***", 1)
         # List of maps to convert from nc to m
-            # 1. nc-map file name, 2. Variable Name, 3. Output Name, 4. Has time dimension (boolean), 5. Timestep, 6. 3rd Dimension index -in case of filtering (boolean), 7. M-file header comment, 8. Multiplier
+            # 1. nc-map file name, 2. Variable Name, 3. Output Name, 4. Has time dimension (boolean), 5. Timestep, 6. 3rd Dimension index -in case of filtering (index, None or False for no filter), 7. M-file header comment, 8. Multiplier
         nc2m_maps_list = [
             ['GLANDCOVERDETAIL_30MIN_HE.nc','GLANDCOVERDETAIL_30MIN','Half_Earth_constraint',True, 2100, 5,'Half Earth Biodiversity Constraint',1],
             #['GLANDCOVERDETAIL_30MIN_double_AICHI.nc','GLANDCOVERDETAIL_30MIN','Double_AICHI_constraint',True, 27, 5,'Double-AICHI Biodiversity Constraint',1],
@@ -55,51 +69,28 @@ def main(run):
         ]
 
         for outmap in nc2m_maps_list:
-            print("Processing Map: ", outmap[6])
-            write_nc2m = nc2m(outmap[0], outmap[1], outmap[2], outmap[3], outmap[4], outmap[5], outmap[6], outmap[7], mapping)
-            write_nc2m.run_nc2m() 
+            with instrument.job(outmap[6], 'nc2m'):
+                write_nc2m = nc2m(outmap[0], outmap[1], outmap[2], outmap[3], outmap[4], outmap[5], outmap[6], outmap[7], mapping)
+                write_nc2m.run_nc2m() 
     
     if run.list2m or run.list2nc:
-        print("\n***Start processing list data***")
-        from outputs import WriteMaps
-        import pandas as pd
-        # First have to read in nc map with country IDs
-        print("\tReading in nc country-map")
-        cntry_map = nc2m.read_map('blank positional argument', InputDir.data_dir + 'countries_grid.nc', 'layer')
-        
-        # Second have to read in list data with appropriate format:
-        print("\tReading in listed data")
-        list_df = pd.read_excel(InputDir.list_in_dir + 'Mapping_countries_grid_feasibility.xlsx', sheet_name = 'Mapping', header = 1)
-
-        # Identify column in list to be mapped (i.e. variable)
-        map_var = 'spfs_cor'
-
-        # For every country ID on cntry_map, find required value on list_df
-        print("\tAssigning listed data to gridded map")
-        gridmap = np.zeros((360, 720))
-        
-        cntry_map[cntry_map.mask] = cntry_map.fill_value    # have to make sure that the fill value is returned on masked cells
-        for i in range(360):
-            for j in range(720):
-                print("Coordinates: ", i, ', ', j)
-                gridmap[i,j] = list_df.loc[list_df['grdID'] == cntry_map[i,j], map_var].iloc[0]
+        instrument.log("\n***Start processing list data***", 1)
+        # List of columns in listed data to convert to maps
+            # 1. Column (Variable Name), 2. Map Title, 3. Unit, 4. Output Name, 5. M-file header comment
+        list_maps_list = [
+            ['spfs_cor','Socio-political feasability score','-','socio-political_feasability_score','Socio-political feasability score from Roe et al (2021)'],
+        ]
 
-        gridmap = np.ma.masked_where(gridmap == cntry_map.fill_value, gridmap)
+        # 1. List file name, 2. Sheet name, 3. Header row, 4. ID column, 5. nc ID-map file name, 6. ID-map variable name
+        with instrument.job('Mapping_countries_grid_feasibility.xlsx', 'list'):
+            write_list = list2map('Mapping_countries_grid_feasibility.xlsx', 'Mapping', 1, 'grdID', 'countries_grid.nc', 'layer', mapping)
+            write_list.run_list2map(list_maps_list, run.list2nc, run.list2m)
         
-        if run.list2nc:
-             # 1. Map Tital, 2. Variable Name, 3. Unit, 4. Output Name, 5. Time exit (boolean)
-            list2nc_maps_list = ['Socio-political feasability score',map_var,'-','socio-political_feasability_score',False]
+        instrument.log("done", 1)
 
-            print("\tWriting netCDF output")
-            writemap = WriteMaps(gridmap, list2nc_maps_list[0], list2nc_maps_list[1], list2nc_maps_list[2], list2nc_maps_list[3], list2nc_maps_list[4])
-            writemap.maptime2nc()
-        
-        if run.list2m:
-            from pym import write_mym
-            vectormap = nc2m.get_vectormap('missing positional argument',gridmap, mapping, False)
-            write_mym(data=vectormap, variable_name=map_var, filename='socio-political_feasability_score', path= OutputDir.m_out_dir, comment='Socio-political feasability score from Roe et al (2021)')
-        
-        print("done")
+    # Timings, bytes read/written and peak RSS of all jobs
+    instrument.write_report(OutputDir.report_file)
+    instrument.log("Report written to {}".format(OutputDir.report_file), 1)
 
 if __name__ == "__main__":
     run = RunFunction()
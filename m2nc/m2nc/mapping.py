@@ -0,0 +1,106 @@
+"""
+Mapping between m-map rows and lat/lon grid cells
+
+An m-map is a vector with one value per land cell. The coordinates
+of these cells are listed in mcoord.txt. The mapping stores, for every
+m-map row, the row and column of the cell on the lat/lon grid as well as
+its flat (raveled) index, so that whole maps can be converted at once.
+"""
+import os
+import numpy as np
+from dirs import CacheDir, atomic_open, file_sha1
+from grid import Grid, HALF_DEGREE
+
+
+class CellMapping:
+    """
+    Links each row of an m-map to a x,y coordinate on a lat/lon grid
+
+    Attributes:
+        rows: int32 array with the latitude index of each m-map row
+        cols: int32 array with the longitude index of each m-map row
+        flat: int32 array with the raveled index of each m-map row
+        shape: (nlats, nlons) of the grid
+    """
+    def __init__(self, rows, cols, shape=HALF_DEGREE.shape):
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.cols = np.asarray(cols, dtype=np.int32)
+        self.shape = tuple(int(n) for n in shape)
+        self.flat = np.ravel_multi_index((self.rows, self.cols), self.shape).astype(np.int32)
+
+    @property
+    def grid(self):
+        return Grid(*self.shape)
+
+    def __len__(self):
+        return len(self.flat)
+
+    def scatter(self, values, fill=np.nan, dtype=np.float64):
+        """
+        Converts m-map values to a grid in one vectorized assignment
+
+        values: array whose last axis are the m-map rows, i.e. (NC,) or (time, NC)
+        Returns an array of shape values.shape[:-1] + grid shape; cells without
+        an m-map row are set to fill.
+        """
+        values = np.asarray(values)
+        gridmap = np.full(values.shape[:-1] + (self.shape[0]*self.shape[1],), fill, dtype=dtype)
+        gridmap[..., self.flat] = values
+        return gridmap.reshape(values.shape[:-1] + self.shape)
+
+    def gather(self, gridmap):
+        """
+        Converts a grid to m-map values in one vectorized lookup
+
+        gridmap: array whose last two axes are the grid, i.e. (lat, lon) or (time, lat, lon)
+        Returns an array of shape gridmap.shape[:-2] + (NC,)
+        """
+        gridmap = np.asarray(gridmap)
+        return gridmap.reshape(gridmap.shape[:-2] + (-1,))[..., self.flat]
+
+
+def get_mmapping(grdfile, grid=HALF_DEGREE):
+    """
+    Returns a CellMapping which links the rows of m-maps
+    to an x,y coordinate on a Grid based on the latitudes and longitudes in
+    a defining grdfile (col1 = longitude, col2 = latitude)
+    """
+    nlats, nlons = grid.shape
+    lats = grid.lats
+    lons = grid.lons
+
+    grdfile = np.asarray(grdfile, dtype=np.float64)
+    rows = np.rint((90. - grdfile[:,1]) / grid.resolution).astype(np.int64)
+    cols = np.rint((grdfile[:,0] + 180.) / grid.resolution).astype(np.int64)
+
+    # Every coordinate must fall exactly on a grid point
+    valid = (rows >= 0) & (rows < nlats) & (cols >= 0) & (cols < nlons)
+    valid[valid] = (lats[rows[valid]] == grdfile[valid,1]) & (lons[cols[valid]] == grdfile[valid,0])
+    if not valid.all():
+        raise ValueError("{} rows of the grid file are not on the {}x{} grid".format(np.count_nonzero(~valid), nlats, nlons))
+
+    return CellMapping(rows, cols, grid.shape)
+
+
+def load_mmapping(coord_file, cache_dir=None, grid=HALF_DEGREE):
+    """
+    Returns the CellMapping of a coordinate file (i.e. mcoord.txt) on a Grid
+
+    The mapping is cached as an .npz file keyed on the hash of the coordinate file and the grid,
+    so it only has to be computed the first time a coordinate file is used.
+    """
+    digest = file_sha1(coord_file)
+    cache_dir = cache_dir or CacheDir.mapping_dir
+    cache_file = os.path.join(cache_dir, 'mmapping_{}x{}_{}.npz'.format(grid.nlats, grid.nlons, digest))
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            return CellMapping(cached['rows'], cached['cols'], cached['shape'])
+
+    mapping = get_mmapping(np.loadtxt(coord_file), grid)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with atomic_open(cache_file, 'wb') as f:
+        np.savez(f, rows=mapping.rows, cols=mapping.cols, shape=np.array(mapping.shape))
+
+    return mapping
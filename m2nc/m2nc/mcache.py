@@ -0,0 +1,143 @@
+"""
+On-disk cache of m-maps parsed by pym.read_mym
+
+Parsing the text of an m-map is the dominant cost of m2nc. The parsed data
+(and time) arrays are therefore stored as .npy files, which are read back
+memory-mapped. Entries are content-addressed (sha1 of the m-map), and looked up
+by the path, size and modification time of the m-map so the file is only hashed
+the first time it is seen. The least recently used entries are removed when the
+cache grows beyond its size limit.
+"""
+import os
+import shutil
+import hashlib
+import numpy as np
+from dirs import CacheDir, atomic_open, file_sha1
+
+class MymCache:
+    """
+    Cache of parsed m-maps in cache_dir (CacheDir.mym_dir by default), limited to max_bytes.
+    If not enabled, read_mym is always used
+    """
+    def __init__(self, cache_dir=None, max_bytes=4*1024**3, enabled=True):
+        self._cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir or CacheDir.mym_dir
+
+    @cache_dir.setter
+    def cache_dir(self, cache_dir):
+        self._cache_dir = cache_dir
+
+    def read_mym(self, filename, path=''):
+        """
+        Returns the same as pym.read_mym(filename, path), from the cache when possible
+        """
+        from pym import read_mym
+        if not self.enabled:
+            return read_mym(filename, path=path)
+        return self.get(path + filename, lambda: read_mym(filename, path=path))
+
+    def get(self, file_loc, parse):
+        """
+        Returns the parsed m-map of file_loc from the cache, or the output of parse() if it is not cached
+
+        Parsed m-maps are stored unless they are larger than the cache. Entries removed meanwhile
+        (i.e. evicted by another process) are parsed again.
+        """
+        entry = self.get_entry(file_loc)
+        if os.path.isdir(entry):
+            try:
+                return self.load(entry)
+            except OSError:
+                pass
+
+        parsed = parse()
+        if sum(np.asarray(array).nbytes for array in (parsed if isinstance(parsed, tuple) else (parsed,))) <= self.max_bytes:
+            self.store(entry, parsed)
+            self.evict(keep=entry)
+        return parsed
+
+    def get_entry(self, file_loc):
+        """
+        Returns the cache directory holding the parsed data of an m-map
+        """
+        stat = os.stat(file_loc)
+        key = hashlib.sha1('{}|{}|{}'.format(os.path.abspath(file_loc), stat.st_size, stat.st_mtime_ns).encode()).hexdigest()
+        key_file = os.path.join(self.cache_dir, 'keys', key)
+
+        # Only hash the content of m-maps whose path, size or mtime have not been seen before
+        if os.path.exists(key_file):
+            with open(key_file) as f:
+                digest = f.read().strip()
+        else:
+            digest = file_sha1(file_loc)
+            os.makedirs(os.path.dirname(key_file), exist_ok=True)
+            with atomic_open(key_file) as f:
+                f.write(digest)
+
+        return os.path.join(self.cache_dir, 'data', digest)
+
+    def store(self, entry, parsed):
+        """
+        Stores the output of read_mym (data, or data and time) as .npy files
+        """
+        tmp_entry = entry + '.{}.tmp'.format(os.getpid())
+        os.makedirs(tmp_entry, exist_ok=True)
+        if isinstance(parsed, tuple):
+            np.save(os.path.join(tmp_entry, 'data.npy'), np.asarray(parsed[0]))
+            np.save(os.path.join(tmp_entry, 'time.npy'), np.asarray(parsed[1]))
+        else:
+            np.save(os.path.join(tmp_entry, 'data.npy'), np.asarray(parsed))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:     # Stored meanwhile by another process
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def load(self, entry):
+        """
+        Returns the memory-mapped data (and time) of a cache entry, and marks it as recently used
+        """
+        os.utime(entry)
+        data = np.load(os.path.join(entry, 'data.npy'), mmap_mode='r')
+        if os.path.exists(os.path.join(entry, 'time.npy')):
+            return data, np.load(os.path.join(entry, 'time.npy'))
+        return data
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache is within max_bytes
+        keep: entry which is not removed (i.e. the one just stored)
+        """
+        data_dir = os.path.join(self.cache_dir, 'data')
+        entries = []
+        for name in os.listdir(data_dir):
+            entry = os.path.join(data_dir, name)
+            if name.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry))
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            except OSError:     # Removed meanwhile by another process
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """
+        Removes all cached m-maps
+        """
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+# Cache used by all m2nc conversions of this process
+mym_cache = MymCache()
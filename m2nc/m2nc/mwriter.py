@@ -0,0 +1,83 @@
+"""
+Writers for the vector (m-map) outputs of nc2m
+
+write_mfile: m-map in the IMAGE m-file format, one timestep at a time (tests/data/*.golden;
+    tests/test_m2nc.py checks these against pym.write_mym where pym is installed)
+write_csv: .csv, byte-identical to np.savetxt(..., delimiter=',')
+write_binary: .npy or Parquet side output for downstream tools
+
+Values are formatted a whole timestep (row) at a time with a single
+format string, instead of value by value.
+"""
+import numpy as np
+
+def format_row(row, fmt, delimiter):
+    """
+    Returns all values of a row formatted with fmt and joined by delimiter
+    """
+    return delimiter.join([fmt] * len(row)) % tuple(row.tolist())
+
+def write_mfile(data, filename, path='', years=None, variable_name='data', comment=None, fmt='%.10g'):
+    """
+    Writes an m-map (IMAGE m-file)
+    Inputs:
+    1. Data: (NC,) or (time, NC) array
+    2. File name and path
+    3. Years of each timestep, if there is a time dimension
+    4. Variable name
+    5. Header comment
+    6. Format of values
+
+    The file is written one timestep at a time, so it is never held in memory as text.
+    """
+    data = np.asarray(data)
+    with open(path + filename, 'w') as f:
+        if comment:
+            for line in str(comment).splitlines():
+                f.write('! {}\n'.format(line))
+
+        if years is None:
+            f.write('real {}[{}] = [\n'.format(variable_name, data.shape[-1]))
+            f.write(format_row(data.ravel(), fmt, '\t'))
+            f.write('\n];\n')
+        else:
+            f.write('real {}[{}](t) = [\n'.format(variable_name, data.shape[-1]))
+            for year, row in zip(years, data):
+                f.write('{}\t'.format(year))
+                f.write(format_row(row, fmt, '\t'))
+                f.write('\n')
+            f.write('];\n')
+
+def write_csv(data, file_loc, fmt='%.18e'):
+    """
+    Writes a (NC,) or (time, NC) array as .csv, one row at a time
+    Output is identical to np.savetxt(file_loc, data, delimiter=',')
+    """
+    data = np.asarray(data)
+    with open(file_loc, 'w') as f:
+        if data.ndim == 1:
+            f.write(format_row(data, fmt, '\n'))
+            f.write('\n')
+        else:
+            for row in data:
+                f.write(format_row(row, fmt, ','))
+                f.write('\n')
+
+def write_binary(data, file_loc, years=None, kind='npy'):
+    """
+    Writes a (NC,) or (time, NC) array as binary side output
+        kind:
+            - 'npy': data as file_loc.npy (and years as file_loc_years.npy)
+            - 'parquet': one row per m-map cell, one column per year (requires pandas and pyarrow)
+    """
+    data = np.asarray(data)
+    if kind == 'npy':
+        np.save(file_loc + '.npy', data)
+        if years is not None:
+            np.save(file_loc + '_years.npy', np.asarray(years))
+    elif kind == 'parquet':
+        import pandas as pd
+        columns = [str(year) for year in years] if years is not None else ['data']
+        pd.DataFrame(np.atleast_2d(data).T, columns=columns).to_parquet(file_loc + '.parquet')
+    else:
+        raise ValueError("Unknown binary output kind: {}".format(kind))
@@ -4,21 +4,75 @@ class: WriteMaps
     - Contains methods for producing NetCDF maps and thier metadata
 
 """
-import netCDF4
+import os
+import json
 import datetime as dt
-import subprocess
+import functools
+import threading
 import numpy as np
 from metadata import __version__, __name__, __reference__
 from dirs import OutputDir
+from grid import Grid
+from timeaxis import TIME_UNITS, year_dates
+from instrument import instrument
+
+# Provenance of the tool (repository, revision), written by write_stamp when the tool is built or installed
+STAMP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build_stamp.json')
+
+# netCDF4 (HDF5) is not thread-safe: all netCDF file access of the process is serialised by this lock (see pipeline.py)
+nc_lock = threading.RLock()
+
+@functools.lru_cache(maxsize=None)
+def get_provenance():
+    """
+    Repository and revision of the tool, shared by all outputs of the process:
+    read from the build stamp (STAMP_FILE) if there is one, otherwise from git, once per process
+    """
+    if os.path.exists(STAMP_FILE):
+        with open(STAMP_FILE) as f:
+            stamp = json.load(f)
+        return stamp['repository'], stamp['revision']
+    return git_provenance()
+
+def git_provenance():
+    """
+    Repository (first remote) and revision of the git checkout of the tool, 'Not versioned' if unknown
+    """
+    import subprocess
+
+    tool_dir = os.path.dirname(os.path.abspath(__file__))
+    try: 
+        repository = subprocess.check_output(['git', 'remote', '-v'], cwd=tool_dir, stderr=subprocess.DEVNULL).decode()
+        repository = repository.split()[1]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        repository = 'Not versioned'
+    
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=tool_dir, stderr=subprocess.DEVNULL).decode()
+        revision = revision.split()[0]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        revision = 'Not versioned'
+
+    return repository, revision
+
+def write_stamp():
+    """
+    Writes the build stamp, so that outputs get their provenance without running git:
+        python -c "import outputs; outputs.write_stamp()"
+    """
+    repository, revision = git_provenance()
+    with open(STAMP_FILE, 'w') as f:
+        json.dump({'repository': repository, 'revision': revision}, f, indent=1)
 
 class WriteMaps:
-    def __init__(self, outmap, title, varname, varunit, outname, timexist):
+    def __init__(self, outmap, title, varname, varunit, outname, timexist, years=None):
         self.outmap = outmap
         self.title = title
         self.varname = varname
         self.varunit = varunit
         self.outname = outname
         self.timexist = timexist
+        self.years = years                  # Year of each timestep, written as dates. Timestep numbers if None
 
     def get_ncattributes(self):
         """
@@ -34,42 +88,119 @@ class WriteMaps:
         institution2 = "PBL Netherlands Environmental Assessment Agency (http://www.pbl.nl/en)"
         references = __reference__
         disclaimer = "http://themasites.pbl.nl/models/image/index.php/IMAGE-rights"
-        
-        try: 
-            repository = subprocess.check_output(['git', 'remote', '-v'])
-            repository = repository.split()[1]
-             
-        except:
-            repository = 'Not versioned'
-        
-        try:
-            revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'])
-            revision = revision.split()[0]
-        except:
-            revision = 'Not versioned'
+        repository, revision = get_provenance()
         
         return title, unit, author, contact, date, model, repository, revision, institution, institution2, references, disclaimer
 
-    def maptime2nc(self, dim1='EMPTY'):
+    def get_chunksizes(self, shape, chunking, dims):
+        """
+        Chunk shape of the output variable
+            chunking:
+                - 'map': one chunk per timestep and class (fast reading of whole maps, i.e. map viewers)
+                - 'timeseries': all timesteps and classes of 30x30 cell tiles (fast point/time-series extraction)
+                - tuple: explicit chunk shape
+                - None: netCDF library default
+        """
+        if chunking is None:
+            return None
+        if chunking == 'map':
+            return [1 if d in ('time', 'dimension1') else n for d, n in zip(dims, shape)]
+        if chunking == 'timeseries':
+            return [min(30, n) if d in ('lat', 'lon') else min(900, n) if d == 'landpoint' else n for d, n in zip(dims, shape)]
+        return list(chunking)
+
+    def maptime2nc(self, dim1='EMPTY', variables=None, landpoints=None, **options):
         """
         Creates a netCDF file from a relevant array
         Array must contain at least two axes: latitude, longitude
             Optional additional axes (boolean):
                 - Time
-                - One extra dimenson (i.e. crop type)
+                - One extra dimenson (i.e. crop type), after latitude and longitude
 
         Parameters
         ------
-        outmap: array with map to be created
+        outmap: array with map to be created, or with a leading axis of variables if variables is given
         timexist: Boolean defining if there is a time dimension
         
-        Dictionary of the definition of the first dimension
+        dim1: Definition of the extra dimension, see create_nc
+        variables: List of (name, standard name, unit) of several variables to write to the same file
+        landpoints: Cell mapping of the land points, if the map is stored as land points (see create_nc)
         outname: String with the name of the output file (excluding .nc)
+        options: Storage options, see create_nc
+
+        Returns the contents of the file (memoryview) if it is created in memory (in_memory option of create_nc)
 
         Attributes:
             title: String with the title of the intended output
             varname: String with the name of the variable being presented
             varunit: String with the unit of the variable being presented
+        """
+        shape = np.shape(self.outmap)[1:] if variables else np.shape(self.outmap)
+        with nc_lock:
+            ncfile, var = self.create_nc(shape, dim1, variables, landpoints, **options)
+
+            try:
+                if variables:
+                    for var_out, outmap in zip(var, self.outmap):
+                        var_out[:] = outmap
+                else:
+                    var[:] = self.outmap
+            finally:
+                memory = ncfile.close()
+        return memory
+
+    def stream2nc(self, gridslices, shape, dim1='EMPTY', variables=None, landpoints=None, **options):
+        """
+        Creates a netCDF file with a time dimension, writing one timestep at a time,
+        so that only a single (lat, lon) grid has to be held in memory
+
+        Parameters
+        ------
+        gridslices: iterable with the (lat, lon(, dimension1)) grid of each timestep,
+                    with a leading axis of variables if variables is given
+        shape: (time, lat, lon(, dimension1)) shape of the output variable(s), (time, landpoint(, dimension1)) if stored as land points
+        dim1, variables, landpoints: see maptime2nc
+        options: Storage options, see create_nc
+
+        Returns the contents of the file (memoryview) if it is created in memory
+        """
+        with nc_lock:
+            ncfile, var = self.create_nc(shape, dim1, variables, landpoints, **options)
+            nc_vars = var if variables else [var]
+
+            try:
+                for t, gridslice in enumerate(gridslices):
+                    for var_out, varslice in zip(nc_vars, gridslice if variables else [gridslice]):
+                        var_out[t] = varslice
+            finally:
+                memory = ncfile.close()
+        return memory
+
+    def create_nc(self, shape, dim1='EMPTY', variables=None, landpoints=None, in_memory=False, zlib=True, complevel=4, shuffle=True, dtype=np.float64, chunking='map', least_significant_digit=None):
+        """
+        Creates a netCDF file with its dimensions, attributes and coordinates
+        Returns the open netCDF file and the (empty) output variable, or the list of output variables if variables is given
+        The file must be written and closed while holding nc_lock
+
+        Parameters
+        ------
+        shape: Shape of the map to be written, (time,) lat, lon (, dimension1), or (time,) landpoint (, dimension1)
+        dim1: Extra dimension (i.e. crop type), 'EMPTY' if none:
+            - number of classes: labelled 1..n
+            - list of class names: labelled 1..n, names stored in the 'labels' attribute
+            - dictionary of class name: label
+        variables: List of (name, standard name, unit) of the variables to create.
+                   By default a single variable (outname, varname, varunit)
+        landpoints: Cell mapping (mapping.CellMapping). If given, only the cells of the mapping are stored, along a
+                    'landpoint' dimension instead of lat and lon (CF "compression by gathering"): the 'landpoint'
+                    variable holds the index of each cell in the flattened (lat, lon) grid
+        in_memory: Create the file in memory instead of in the output directory. Closing the file returns its contents
+
+        Storage options:
+            zlib, complevel, shuffle: Compression (lossless), level 1-9
+            dtype: Storage type of the variable (i.e. np.float32 to halve file size)
+            chunking: Chunk shape, see get_chunksizes
+            least_significant_digit: Quantise data to this number of decimals before compression (lossy). None by default
         
         Proecdure:
             1. Creates an netCDF object (ncfile) in relevant output directory with relelvant name
@@ -80,19 +211,33 @@ class WriteMaps:
         Code based on an original from Utpal Rai:
         https://iescoders.com/writing-netcdf4-data-in-python/
 
-        TODO:
-        Time dimension labels are wrong.
+        The time coordinate holds the date (1 January) of each year in self.years, or the
+        timestep numbers if the years are unknown.
         """
+        if self.timexist and self.years is not None and len(self.years) != shape[0]:
+            raise ValueError("{} years given for {} timesteps".format(len(self.years), shape[0]))
+
+        import netCDF4
+
         # Create nc-file with correct dimensions
-        ncfile = netCDF4.Dataset(OutputDir.nc_out_dir + self.outname + '.nc', mode='w', format='NETCDF4_CLASSIC')
+        if in_memory:
+            ncfile = netCDF4.Dataset(self.outname + '.nc', mode='w', format='NETCDF4_CLASSIC', memory=1) # memory: initial size, grows as needed
+        else:
+            ncfile = netCDF4.Dataset(OutputDir.nc_out_dir + self.outname + '.nc', mode='w', format='NETCDF4_CLASSIC')
         
-        if self.timexist:
-            lat_dim = ncfile.createDimension('lat', len(self.outmap[0])) # latitude axis
-            lon_dim = ncfile.createDimension('lon', len(self.outmap[0][0])) # longitude axis
-            time_dim = ncfile.createDimension('time', len(self.outmap)) # time axis
+        if landpoints is not None:
+            lat_dim = ncfile.createDimension('lat', landpoints.shape[0]) # latitude axis
+            lon_dim = ncfile.createDimension('lon', landpoints.shape[1]) # longitude axis
+            ncfile.createDimension('landpoint', len(landpoints)) # land point axis
+            if self.timexist:
+                time_dim = ncfile.createDimension('time', shape[0]) # time axis
+        elif self.timexist:
+            lat_dim = ncfile.createDimension('lat', shape[1]) # latitude axis
+            lon_dim = ncfile.createDimension('lon', shape[2]) # longitude axis
+            time_dim = ncfile.createDimension('time', shape[0]) # time axis
         else:
-            lat_dim = ncfile.createDimension('lat', len(self.outmap)) # latitude axis
-            lon_dim = ncfile.createDimension('lon', len(self.outmap[0])) # longitude axis
+            lat_dim = ncfile.createDimension('lat', shape[0]) # latitude axis
+            lon_dim = ncfile.createDimension('lon', shape[1]) # longitude axis
 
         if dim1 != 'EMPTY':
             try:
@@ -101,7 +246,8 @@ class WriteMaps:
                 dim1_dim = ncfile.createDimension('dimension1', dim1) # dim1 axis if scalar
 
         # Global Attributes
-        ncfile.title, ncfile.unit, ncfile.author, ncfile.contact, ncfile.date, ncfile.model, ncfile.repository, ncfile.revision, ncfile.institution, ncfile.institution2, ncfile.references, ncfile.disclaimer = self.get_ncattributes()
+        with instrument.stage('metadata'):
+            ncfile.title, ncfile.unit, ncfile.author, ncfile.contact, ncfile.date, ncfile.model, ncfile.repository, ncfile.revision, ncfile.institution, ncfile.institution2, ncfile.references, ncfile.disclaimer = self.get_ncattributes()
 
         # Define variables concerning:
         #  (i) Latitude, (ii) Logitude, (iii) Time, (iv) Extra dimention
@@ -115,28 +261,36 @@ class WriteMaps:
         
         if self.timexist:
             time = ncfile.createVariable('time', np.float64, ('time',))
-            time.units = 'days since 1970-01-01'
-            time.standard_name = 'time'
+            if self.years is not None:
+                time.units = TIME_UNITS
+                time.calendar = 'standard'
+                time.standard_name = 'time'
+            else:
+                time.long_name = 'timestep'
         
         if dim1 != 'EMPTY':
             dim1_var = ncfile.createVariable('dimension1', np.float32, ('dimension1',))
-            dim1_var.standard_name = str(dim1)
+            dim1_var.long_name = 'class'
             dim1_var.units = '-'
+
+        if landpoints is not None:
+            landpoint = ncfile.createVariable('landpoint', np.int32, ('landpoint',))
+            landpoint.compress = 'lat lon'
+            landpoint.long_name = 'index of the land point in the flattened (lat, lon) grid'
+            landpoint[:] = landpoints.flat
         
         # Assign these variables to an ncfile
-        if dim1 == 'EMPTY':
-            if self.timexist:
-                var = ncfile.createVariable(self.outname,np.float64,('time','lat','lon'))
-            else:
-                var = ncfile.createVariable(self.outname,np.float64,('lat','lon'))
-        else:
-            if self.timexist:
-                var = ncfile.createVariable(self.outname,np.float64,('time','lat','lon','dimension1'))
-            else:
-                var = ncfile.createVariable(self.outname,np.float64,('lat','lon','dimension1'))
-        
-        var.standard_name = self.varname
-        var.units = self.varunit
+        space_dims = ('landpoint',) if landpoints is not None else ('lat','lon')
+        dims = (('time',) if self.timexist else ()) + space_dims + (('dimension1',) if dim1 != 'EMPTY' else ())
+
+        nc_vars = []
+        for name, standard_name, unit in variables or [(self.outname, self.varname, self.varunit)]:
+            var = ncfile.createVariable(name, dtype, dims, zlib=zlib, complevel=complevel, shuffle=shuffle,
+                                        chunksizes=self.get_chunksizes([len(ncfile.dimensions[d]) for d in dims], chunking, dims),
+                                        least_significant_digit=least_significant_digit)
+            var.standard_name = standard_name
+            var.units = unit
+            nc_vars.append(var)
 
         # Writing data in first variable
         nlats = len(lat_dim)
@@ -148,34 +302,22 @@ class WriteMaps:
         if dim1 != 'EMPTY':
             ndim1 = len(dim1_dim)
      
-        lat[:] = 90. - (180./nlats)*np.arange(nlats) # north pole to south pole
-        lon[:] = -180. + (180./nlats)*np.arange(nlons) # 180degree longitude eastward
-        if dim1 != 'EMPTY':
-            dim1_var[:] = np.arange(ndim1) # 1st dimension length
-        
-        if self.timexist:
-            time[:] = np.arange(ntimes) # times values 1:length
-            var[:,:,:] = self.outmap[:,:,:]
-        else:
-            var[:,:] = self.outmap[:,:]
-
+        grid = Grid(nlats, nlons)
+        lat[:] = grid.lats # north pole to south pole
+        lon[:] = grid.lons # 180degree longitude eastward
         if self.timexist:
-            dates = [dt.datetime(1970,1,1,0),dt.datetime(1975,1,1,0),dt.datetime(1980,1,1,0),dt.datetime(1985,1,1,0),
-                    dt.datetime(1990,1,1,0),dt.datetime(1995,1,1,0),dt.datetime(2000,1,1,0),dt.datetime(2005,1,1,0),
-                    dt.datetime(2010,1,1,0),dt.datetime(2015,1,1,0),dt.datetime(2020,1,1,0),dt.datetime(2025,1,1,0),
-                    dt.datetime(2030,1,1,0),dt.datetime(2035,1,1,0),dt.datetime(2040,1,1,0),dt.datetime(2045,1,1,0),
-                    dt.datetime(2050,1,1,0),dt.datetime(2055,1,1,0),dt.datetime(2060,1,1,0),dt.datetime(2065,1,1,0),
-                    dt.datetime(2070,1,1,0),dt.datetime(2075,1,1,0),dt.datetime(2080,1,1,0),dt.datetime(2085,1,1,0),
-                    dt.datetime(2090,1,1,0),dt.datetime(2095,1,1,0),dt.datetime(2100,1,1,0)]
-
-            time = netCDF4.date2num(dates, time.units)
+            if self.years is not None:
+                time[:] = year_dates(self.years)   # 1 January of each year
+            else:
+                time[:] = np.arange(ntimes)         # timestep numbers
 
         if dim1 != 'EMPTY':
             try:
-                dim1_labels = dim1.values()                 # Assign dictionary values
-                dim1_var = dim1_labels
+                dim1_var[:] = list(dim1.values())                   # Assign dictionary values
+                dim1_var.labels = ','.join(str(name) for name in dim1)
             except AttributeError:
-                dim1_labels = [i + 1 for i in range(dim1)]  # Simply set a list of indices
-                dim1_var = dim1_labels
+                dim1_var[:] = [i + 1 for i in range(ndim1)]         # Simply set a list of indices
+                if not np.isscalar(dim1):
+                    dim1_var.labels = ','.join(str(name) for name in dim1)
 
-        ncfile.close()
+        return ncfile, (nc_vars if variables else nc_vars[0])
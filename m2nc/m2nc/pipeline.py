@@ -0,0 +1,104 @@
+"""
+Pipelined execution of conversions, overlapping the reading, mapping and writing of consecutive jobs
+
+Reading (pym, netCDF4) and writing (netCDF, m-files, .csv) leave the CPU mostly idle.
+Jobs are therefore passed through three threads connected by bounded queues:
+
+    read job N+1  ->  convert job N  ->  write job N-1
+
+Converters with separate stages (m2nc and nc2m: read, convert, write) are split
+over the threads. Other converters run as a whole in the convert thread.
+At most in_flight jobs are held in memory at once: a job is only read once an
+earlier job has been written.
+"""
+import queue
+import threading
+import traceback
+from instrument import instrument
+
+class WholeJob:
+    """
+    Converter without separate stages, run as a whole (i.e. list2map, map2region)
+    """
+    def __init__(self, run):
+        self.run = run
+
+    def read(self):
+        pass
+
+    def convert(self):
+        self.run()
+
+    def write(self):
+        pass
+
+def run_pipeline(jobs, in_flight=3):
+    """
+    Runs jobs through the read, convert and write threads and returns their summaries in order:
+    the instrumentation record (see instrument.py), status ('ok' or 'failed') and error (if any)
+
+    jobs: iterable of (name, type, make_converter), make_converter returning an object with
+          read, convert and write methods. Converters are created in the read thread, and
+          released once written
+    in_flight: maximum number of jobs between reading and writing
+    """
+    slots = threading.BoundedSemaphore(in_flight)
+    to_convert = queue.Queue(maxsize=1)
+    to_write = queue.Queue(maxsize=1)
+    results = []
+
+    def run_stage(job, stage):
+        """
+        Runs a stage of job, unless an earlier stage failed
+        """
+        if job['record']['status'] != 'ok':
+            return
+        try:
+            with instrument.attach(job['record']):
+                stage(job)
+        except Exception:
+            job['record'].update(status='failed', error=traceback.format_exc())
+            instrument.log("\tFailed: {}".format(job['record']['name']), 1)
+
+    def read():
+        try:
+            for name, kind, make_converter in jobs:
+                slots.acquire()
+                record = instrument.start_job(name, kind)
+                record.update(status='ok', error=None)
+                results.append(record)
+                job = {'record': record}
+                run_stage(job, lambda job: job.update(converter=make_converter()))
+                run_stage(job, lambda job: job['converter'].read())
+                to_convert.put(job)
+        finally:
+            to_convert.put(None)
+
+    def convert():
+        try:
+            while True:
+                job = to_convert.get()
+                if job is None:
+                    break
+                run_stage(job, lambda job: job['converter'].convert())
+                to_write.put(job)
+        finally:
+            to_write.put(None)
+
+    def write():
+        while True:
+            job = to_write.get()
+            if job is None:
+                break
+            run_stage(job, lambda job: job['converter'].write())
+            instrument.end_job(job['record'])
+            job.clear()
+            slots.release()
+
+    threads = [threading.Thread(target=target, name='pipeline-' + target.__name__, daemon=True) for target in (read, convert, write)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
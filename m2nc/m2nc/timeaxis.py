@@ -0,0 +1,85 @@
+"""
+Time axes of maps: the years of the timesteps of m-maps (pym.read_mym) and netCDF maps
+(the 'time' coordinate), and the selection of years as timestep indices, so that only
+the selected timesteps have to be read.
+
+netCDF maps are written with one date per timestep (1 January of its year), in TIME_UNITS.
+"""
+import datetime as dt
+import numpy as np
+
+TIME_UNITS = 'days since 1970-01-01'
+
+# Layouts of IMAGE nc-maps selected by the nc2m 'timestep' setting (before years could be given):
+# years of the timesteps (if the nc-map has no time coordinate), and the selected years
+LEGACY_SUBSETS = {
+    132: (range(1970, 2102), [1971, 2000, 2020, 2050, 2100]),      # Annual to 2101
+    27: (range(1970, 2101, 5), [1970, 2000, 2020, 2050, 2100]),    # 5 year increments to 2100
+    17: (range(1970, 2051, 5), [1970, 2020, 2050, 2050]),          # 5 year increments to 2050
+}
+
+def read_years(nc_map):
+    """
+    Returns the years of the timesteps of an open netCDF map, from its time coordinate.
+    None if there is no time coordinate, or if it does not have one timestep per year
+    (i.e. timestep numbers, or monthly data)
+    """
+    if 'time' not in nc_map.variables:
+        return None
+    time = nc_map.variables['time']
+    values = np.asarray(time[:])
+    units = getattr(time, 'units', '').strip()
+
+    if ' since ' in units:
+        import netCDF4
+        try:
+            dates = netCDF4.num2date(values, units, getattr(time, 'calendar', 'standard'))
+        except ValueError:  # Units which cannot be decoded, i.e. 'years since' or 'months since' on the standard calendar
+            return None
+        years = np.array([date.year for date in np.atleast_1d(dates)])
+    elif units.lower() in ('year', 'years', 'yr'):
+        years = values.astype(np.int64)
+    else:
+        return None
+
+    if len(years) > 1 and np.any(np.diff(years) <= 0):
+        return None
+    return years
+
+def calendar_years(years):
+    """
+    Returns years as a list if they are calendar years, None if they are timestep numbers (i.e. 0, 1, 2, ...)
+    """
+    years = [int(year) for year in years]
+    if all(1000 <= year <= 9999 for year in years):
+        return years
+    return None
+
+def year_index(available, years, extend_first=False):
+    """
+    Returns the index of each of years in the available years of a time axis
+    If extend_first, years before the first available year take the first timestep
+    """
+    available = [int(year) for year in available]
+    position = {year: i for i, year in enumerate(available)}
+    index = []
+    for year in years:
+        if int(year) in position:
+            index.append(position[int(year)])
+        elif extend_first and available and year < available[0]:
+            index.append(0)
+        else:
+            raise ValueError("Year {} is not in the time axis ({})".format(year, format_years(available)))
+    return index
+
+def year_dates(years):
+    """
+    Returns the date of each year (1 January) in TIME_UNITS
+    """
+    return np.array([(dt.datetime(int(year), 1, 1) - dt.datetime(1970, 1, 1)).days for year in years], dtype=np.float64)
+
+def format_years(years):
+    years = list(years)
+    if len(years) > 6:
+        return '{}, {}, ..., {}'.format(years[0], years[1], years[-1])
+    return ', '.join(str(year) for year in years)
@@ -0,0 +1,40 @@
+"""
+Shared by the batch runner (batch.py) and the comparison of maps (compare.py):
+reading their lists of jobs (manifests, pairs files) and setting up their worker processes
+"""
+import json
+import dirs
+from instrument import instrument
+from mcache import mym_cache
+
+# Cell mapping of the current process, set once per worker (see init_worker)
+mapping = None
+
+def read_entries(file_loc, key):
+    """
+    Returns the list of entries (i.e. jobs or pairs) in a JSON or TOML file:
+    the list under key, or the list the file consists of
+    """
+    if file_loc.lower().endswith('.toml'):
+        import tomllib
+        with open(file_loc, 'rb') as f:
+            entries = tomllib.load(f)
+    else:
+        with open(file_loc) as f:
+            entries = json.load(f)
+    return entries[key] if isinstance(entries, dict) else entries
+
+def init_worker(cell_mapping, verbosity=instrument.verbosity, dir_settings=None, cache_enabled=None, cache_max_bytes=None):
+    """
+    Sets up the current process (a pool worker, or the main process) to run jobs: the cell mapping,
+    the directories (see dirs.settings), the verbosity and the m-map cache settings (unchanged if None)
+    """
+    global mapping
+    mapping = cell_mapping
+    if dir_settings:
+        dirs.configure(**dir_settings)
+    instrument.verbosity = verbosity
+    if cache_enabled is not None:
+        mym_cache.enabled = cache_enabled
+    if cache_max_bytes is not None:
+        mym_cache.max_bytes = cache_max_bytes
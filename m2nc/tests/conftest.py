@@ -0,0 +1,7 @@
+"""
+The m2nc modules import each other by module name, as when run from the m2nc directory
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'm2nc'))
@@ -0,0 +1,240 @@
+"""
+Checks of the conversions between m-maps, grids and netCDF maps
+
+Run from the m2nc folder with: python -m pytest tests
+"""
+import os
+import numpy as np
+import numpy.ma as ma
+import pytest
+import api
+from aggregate import RegionIndex, aggregate, map2region
+from compare import MapSteps
+from functions import join_list, single_timestep
+from grid import Grid, regrid
+from mapping import CellMapping
+from mcache import MymCache
+from mwriter import write_mfile
+
+# Half degree mapping of a few cells: the first four are one 1 degree cell
+MAPPING = CellMapping([100, 100, 101, 101, 200, 250], [300, 301, 300, 301, 10, 700])
+NC = len(MAPPING)
+
+def random_mmap(*shape):
+    return np.random.default_rng(0).random(shape + (NC,))
+
+
+def test_scatter_gather():
+    values = random_mmap(3)
+    gridmap = MAPPING.scatter(values)
+    assert gridmap.shape == (3, 360, 720)
+    assert np.count_nonzero(~np.isnan(gridmap)) == 3 * NC
+    assert gridmap[1, 200, 10] == values[1, 4]
+    np.testing.assert_array_equal(MAPPING.gather(gridmap), values)
+
+def test_regional_table_years(tmp_path):
+    index = RegionIndex([10, 20], [0, 0, 0, 0, 1, 2], np.ones(NC))
+    stats = aggregate(random_mmap(2), index)
+    converter = map2region('v.dat', 'v', 'v', True, MAPPING)
+    converter.write_csv(stats, index.regions, str(tmp_path / 'v.csv'), [2020, 2050])
+    table = np.loadtxt(tmp_path / 'v.csv', delimiter=',', skiprows=1)
+    np.testing.assert_array_equal(table[:, 0], [2020, 2020, 2050, 2050])
+    np.testing.assert_array_equal(table[:, 1], [10, 20, 10, 20])
+
+def test_single_timestep():
+    # m-maps without time, read by pym as rows or as a vector of cells (with or without classes)
+    values = random_mmap()
+    for mmap in (values, values[np.newaxis], np.stack([values, values + 1])):
+        np.testing.assert_array_equal(single_timestep(mmap, MAPPING), values[np.newaxis])
+    classes = np.stack([values, values + 1], axis=-1)
+    np.testing.assert_array_equal(single_timestep(classes, MAPPING), classes[np.newaxis])
+
+def test_join_list():
+    idmap = ma.masked_equal([[1, 2], [3, -1]], -1)
+    gridmaps, missing_ids, blank_rows = join_list(idmap, [2, np.nan, 1, 5], [[20., 200.], [0., 0.], [10., 100.], [50., 500.]])
+    assert gridmaps.shape == (2, 2, 2)
+    np.testing.assert_array_equal(gridmaps[0].filled(np.nan), [[10., 20.], [np.nan, np.nan]])
+    np.testing.assert_array_equal(gridmaps[1].filled(np.nan), [[100., 200.], [np.nan, np.nan]])
+    assert list(missing_ids) == [3]
+    assert list(blank_rows) == [1]
+
+def test_aggregate():
+    # Cells 0-3 in region 10, cell 4 in region 20, cell 5 without region
+    index = RegionIndex([10, 20], [0, 0, 0, 0, 1, 2], [1., 1., 2., 4., 1., 1.])
+    values = np.array([[1., 2., 3., np.nan, 5., 6.], [0., 0., 0., 8., np.nan, 6.]])
+    stats = aggregate(values, index)
+    np.testing.assert_array_equal(stats['sum'], [[6., 5.], [8., 0.]])
+    np.testing.assert_array_equal(stats['count'], [[3, 1], [4, 0]])
+    np.testing.assert_array_equal(stats['mean'], [[2., 5.], [2., np.nan]])
+    np.testing.assert_array_equal(stats['area_mean'], [[2.25, 5.], [4., np.nan]])
+    np.testing.assert_array_equal(stats['min'], [[1., 5.], [0., np.nan]])
+    np.testing.assert_array_equal(stats['max'], [[3., 5.], [8., np.nan]])
+
+
+def test_regrid_coarsen():
+    gridmap = np.arange(16, dtype=np.float64).reshape(4, 4)
+    coarse = regrid(gridmap, Grid(4, 4), Grid(2, 2))
+    np.testing.assert_array_equal(coarse, [[2.5, 4.5], [10.5, 12.5]])
+    coarse = regrid(gridmap, Grid(4, 4), Grid(2, 2), how='sum')
+    np.testing.assert_array_equal(coarse, [[10, 18], [42, 50]])
+
+def test_regrid_refine():
+    gridmap = np.array([[1., 2.], [3., 4.]])
+    # Default settings refine by copying, whatever the coarsening method
+    fine = regrid(gridmap, Grid(2, 2), Grid(4, 4))
+    np.testing.assert_array_equal(fine, np.kron(gridmap, np.ones((2, 2))))
+    fine = regrid(gridmap, Grid(2, 2), Grid(4, 4), how='sum', refine_how='split')
+    np.testing.assert_array_equal(fine, np.kron(gridmap, np.ones((2, 2))) / 4)
+
+
+# Stored m-files of MFILE_DATA, which both the native writer and pym.write_mym have to reproduce byte for byte
+MFILE_DATA = np.array([[0.1, 1/3, 2.5e-7, 0., -1.], [1e6, 12.5, np.pi, 7., 0.02]])
+MFILE_YEARS = [1970, 1975]
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', '')
+
+@pytest.mark.parametrize('years, golden', [(MFILE_YEARS, 'mfile_t.golden'), (None, 'mfile.golden')])
+def test_write_mfile_golden(tmp_path, years, golden):
+    data = MFILE_DATA if years is not None else MFILE_DATA[0]
+    write_mfile(data, 'native', path=str(tmp_path) + os.sep, years=years, comment='Golden m-file')
+    with open(GOLDEN_DIR + golden, 'rb') as f:
+        assert (tmp_path / 'native').read_bytes() == f.read()
+
+@pytest.mark.parametrize('years, golden', [(MFILE_YEARS, 'mfile_t.golden'), (None, 'mfile.golden')])
+def test_golden_mfile_is_pym_output(tmp_path, years, golden):
+    pym = pytest.importorskip('pym')
+    data = MFILE_DATA if years is not None else MFILE_DATA[0]
+    if years is not None:
+        pym.write_mym(data=data, years=years, variable_name='data', filename='pym', path=str(tmp_path) + os.sep, comment='Golden m-file')
+    else:
+        pym.write_mym(data=data, variable_name='data', filename='pym', path=str(tmp_path) + os.sep, comment='Golden m-file')
+    with open(GOLDEN_DIR + golden, 'rb') as f:
+        assert (tmp_path / 'pym').read_bytes() == f.read()
+
+
+def cached_mmap(cache, file_loc, parsed, calls):
+    def parse():
+        calls.append(file_loc)
+        return parsed
+    return cache.get(str(file_loc), parse)
+
+def test_mcache_store_and_hit(tmp_path):
+    cache = MymCache(str(tmp_path / 'cache'))
+    (tmp_path / 'v.dat').write_text('m-map')
+    parsed, calls = (random_mmap(2), np.array([1970, 1975])), []
+    for _ in range(2):
+        data, time = cached_mmap(cache, tmp_path / 'v.dat', parsed, calls)
+        np.testing.assert_array_equal(data, parsed[0])
+        np.testing.assert_array_equal(time, parsed[1])
+    assert len(calls) == 1
+
+def test_mcache_eviction(tmp_path):
+    # Room for one entry: storing the second evicts the first, never the one just stored
+    parsed, calls = random_mmap(200), []
+    cache = MymCache(str(tmp_path / 'cache'), max_bytes=int(1.5 * parsed.nbytes))
+    for name in ('a.dat', 'b.dat', 'a.dat'):
+        (tmp_path / name).write_text(name)
+        np.testing.assert_array_equal(cached_mmap(cache, tmp_path / name, parsed, calls), parsed)
+    assert len(calls) == 3
+    assert len(os.listdir(tmp_path / 'cache' / 'data')) == 1
+
+def test_mcache_entry_over_limit(tmp_path):
+    cache = MymCache(str(tmp_path / 'cache'), max_bytes=1000)
+    (tmp_path / 'v.dat').write_text('m-map')
+    parsed, calls = random_mmap(200), []
+    for _ in range(2):
+        np.testing.assert_array_equal(cached_mmap(cache, tmp_path / 'v.dat', parsed, calls), parsed)
+    assert len(calls) == 2
+    assert not os.path.exists(tmp_path / 'cache' / 'data')
+
+
+@pytest.mark.parametrize('layout', ['grid', 'landpoint'])
+@pytest.mark.parametrize('timexist', [True, False])
+def test_round_trip(layout, timexist):
+    # m -> nc -> m of float64 values is exact
+    values = random_mmap(4) if timexist else random_mmap()
+    dataset = api.to_dataset(values, 'v', timexist=timexist, mapping=MAPPING, layout=layout)
+    np.testing.assert_array_equal(api.from_dataset(dataset, 'v', MAPPING), values)
+
+def test_round_trip_float32():
+    values = random_mmap(2)
+    dataset = api.to_dataset(values, 'v', timexist=True, mapping=MAPPING, dtype=np.float32)
+    np.testing.assert_array_equal(api.from_dataset(dataset, 'v', MAPPING), values.astype(np.float32))
+
+@pytest.mark.parametrize('dim3_index', [0, 2])
+def test_round_trip_classes(dim3_index):
+    values = np.moveaxis(random_mmap(2, 3), 1, -1)     # (time, cells, classes)
+    dataset = api.to_dataset(values, 'v', timexist=True, mapping=MAPPING)
+    np.testing.assert_array_equal(api.from_dataset(dataset, 'v', MAPPING, dim3_index=dim3_index), values[..., dim3_index])
+
+def test_round_trip_one_degree():
+    # m -> 1 degree nc -> m: coarsened by mean, refined by copy
+    values = np.array([[1., 2., 3., 6., 5., 7.]])
+    gridmap = api.to_grid(values, MAPPING, out_res=1)
+    assert gridmap.shape == (1, 180, 360)
+    assert gridmap[0, 50, 150] == 3.
+    import netCDF4
+    one_degree = netCDF4.Dataset('one_degree.nc', 'w', diskless=True)
+    one_degree.createDimension('time', 1)
+    one_degree.createDimension('lat', 180)
+    one_degree.createDimension('lon', 360)
+    one_degree.createVariable('v', 'f8', ('time', 'lat', 'lon'))[:] = np.nan_to_num(gridmap)
+    np.testing.assert_array_equal(api.from_dataset(one_degree, 'v', MAPPING), [[3., 3., 3., 3., 5., 7.]])
+    one_degree.close()
+
+def write_nc(file_loc, values, timexist):
+    from outputs import WriteMaps
+    writemap = WriteMaps(MAPPING.scatter(values), 'v', 'v', '-', 'v', timexist)
+    file_loc.write_bytes(bytes(writemap.maptime2nc(in_memory=True)))
+
+def test_compare_reads_float64(tmp_path):
+    values = random_mmap(2)
+    write_nc(tmp_path / 'v.nc', values, True)
+    steps = list(MapSteps(str(tmp_path / 'v.nc'), MAPPING))
+    np.testing.assert_array_equal(steps, values)
+
+def test_compare_mmap_without_time(tmp_path, monkeypatch):
+    pym = pytest.importorskip('pym')
+    import dirs
+    from compare import compare_maps
+    monkeypatch.setattr(dirs.CacheDir, 'mym_dir', str(tmp_path / 'cache') + os.sep)
+    values = random_mmap()
+    pym.write_mym(data=values, variable_name='data', filename='v.dat', path=str(tmp_path) + os.sep)
+    write_nc(tmp_path / 'v.nc', values, False)
+    ntimes_a, ntimes_b, stats = compare_maps(str(tmp_path / 'v.dat'), str(tmp_path / 'v.nc'), MAPPING)
+    assert ntimes_a == ntimes_b == 1
+    assert stats['changed'][-1] == 0
+
+@pytest.mark.parametrize('units, years', [('days since 1970-01-01', [1970, 1975]), ('years since 1970-01-01', None),
+                                          ('months since 1970-01-01', None)])
+def test_read_years(units, years):
+    import netCDF4
+    from timeaxis import read_years
+    dataset = netCDF4.Dataset('time.nc', 'w', diskless=True)
+    dataset.createDimension('time', 2)
+    time = dataset.createVariable('time', 'f8', ('time',))
+    time.units = units
+    time[:] = [0, 1826]
+    # Time axes which cannot be decoded are read as timestep numbers
+    assert (list(read_years(dataset)) if years else read_years(dataset)) == years
+    dataset.close()
+
+def test_no_class_selected():
+    # False selects no class, the same as None
+    values = random_mmap()
+    dataset = api.to_dataset(values, 'v', mapping=MAPPING)
+    np.testing.assert_array_equal(api.from_dataset(dataset, 'v', MAPPING, dim3_index=False), values)
+    dataset.close()
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('dim3_index', [None, 1])
+def test_from_xarray_dataset(dtype, dim3_index):
+    # xarray datasets are read the same as netCDF4 datasets
+    xr = pytest.importorskip('xarray')
+    values = random_mmap(3) if dim3_index is None else np.moveaxis(random_mmap(3, 2), 1, -1)
+    values[0, 1] = -9999.
+    dataset = api.to_dataset(values, 'v', timexist=True, mapping=MAPPING, dtype=dtype)
+    xr_dataset = xr.open_dataset(xr.backends.NetCDF4DataStore(dataset))
+    for time_index in (None, [2, 0]):
+        np.testing.assert_array_equal(api.from_dataset(xr_dataset, 'v', MAPPING, time_index=time_index, dim3_index=dim3_index, multiplier=2),
+                                      api.from_dataset(dataset, 'v', MAPPING, time_index=time_index, dim3_index=dim3_index, multiplier=2))
+    xr_dataset.close()